@@ -2,4 +2,5 @@ from .core.modeler import Modeler
 from .core.port import Port
 from .core.entity import Entity
 from .core.body import Body
+from .core.cache import BuildCache
 
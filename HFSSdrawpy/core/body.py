@@ -3,16 +3,21 @@ import numpy as np
 
 
 from ..utils import Vector, \
+                   VectorArray, \
                    parse_entry, \
                    check_name, \
-                   find_last_list, \
-                   find_penultimate_list, \
-                   find_corresponding_list, \
+                   check_names, \
+                   ScopeStack, \
+                   compose_move, \
+                   EntityRegistry, \
+                   SpatialIndex, \
+                   bbox_of, \
                    val, \
                    equal_float, \
                    way
 from .entity import Entity
 from .modeler import Modeler
+from .journal import journaled
 from ..path_finding.path_finder import Path
 from .port import Port
 
@@ -27,49 +32,33 @@ class BodyMover():
 
     def __enter__(self):
         #1 We need to keep track of the entities created during the execution of a function
-        if self.body.entities_to_move is None:
-            self.body.entities_to_move = []
-        else:
-            find_last_list(self.body.entities_to_move).append([])
-
-        if self.body.ports_to_move is None:
-            self.body.ports_to_move = []
-        else:
-            find_last_list(self.body.ports_to_move).append([])
+        self.body.entities_to_move.push()
+        self.body.ports_to_move.push()
 
     def __exit__(self, *exc):
 
         #4 We move the entity that were created by the last function
-        list_entities_new = find_last_list(self.body.entities_to_move)
-        list_ports_new = find_last_list(self.body.ports_to_move)
+        list_entities_new = self.body.entities_to_move.innermost()
+        list_ports_new = self.body.ports_to_move.innermost()
         pos, angle = self.body.cursors[-1]
 
-        #5 We move the entities_to_move with the right operation
-        if len(list_entities_new) > 0:
-            self.body.rotate(list_entities_new, angle=angle)
-            self.body.translate(list_entities_new, vector=[pos[0], pos[1], pos[2]])
-
-        if len(list_ports_new) > 0:
-            Port.rotate_ports(list_ports_new, angle)
-            Port.translate_ports(list_ports_new, vector=[
-                                 pos[0], pos[1], pos[2]])
-
-        #6 We empty a part of the 'to_move' lists
-        penultimate_entity_list = find_penultimate_list(self.body.entities_to_move)
-        if penultimate_entity_list:
-            a = penultimate_entity_list.pop(-1)
-            for entity in a:
-                penultimate_entity_list.append(entity)
-        else:
-            self.body.entities_to_move = None
-
-        penultimate_port_list = find_penultimate_list(self.body.ports_to_move)
-        if penultimate_port_list:
-            a = penultimate_port_list.pop(-1)
-            for entity in a:
-                penultimate_port_list.append(entity)
-        else:
-            self.body.ports_to_move = None
+        #5 The move is composed with the pending moves of the inner scopes,
+        # it is applied when the entities or ports are used or when the
+        # outermost scope exits
+        for entity in list_entities_new:
+            entity.pending_move = compose_move(entity.pending_move, angle, pos)
+        for port in list_ports_new:
+            port.pending_move = compose_move(port.pending_move, angle, pos)
+
+        #6 The moved entities and ports join the enclosing scope
+        self.body.entities_to_move.pop()
+        self.body.ports_to_move.pop()
+        self.body.journal.record_move(self.body, list_entities_new, angle, pos,
+                                      len(self.body.entities_to_move) == 0)
+        if len(self.body.entities_to_move) == 0:
+            self.body.apply_moves(list_entities_new)
+        if len(self.body.ports_to_move) == 0:
+            Port.apply_moves(list_ports_new)
 
         self.body.cursors.pop(-1)
         return False
@@ -95,14 +84,31 @@ class Body(Modeler):
         self.ref_name = ref_name
         self.interface = pm.interface
         self.mode = pm.mode # 'hfss' or 'gds'
+        self.journal = pm.journal
+        self.journal.record_body(name, rel_coor, ref_name)
         self.dict_instances[name] = self
-        self.entities = {DEFAULT:[]}  # entities sorted by layer
+        self.entities = EntityRegistry([DEFAULT])  # entities sorted by layer
         self.cursors = [] # tuple to escape list parsing
-        self.ports_to_move = None
-        self.entities_to_move = None
+        self.ports_to_move = ScopeStack()
+        self.entities_to_move = ScopeStack()
+        self.spatial_index = {}  # layer: SpatialIndex of the entities
+        self._bbox_invalid = {}  # entities to (re)index at the next query
 
         pm.bodies.append(self)
 
+    def release(self):
+        # drops the entities and ports of the body once it is written, see
+        # Modeler.write_body
+        for name in [name for name, port in Port.dict_instances.items()
+                     if port.body is self]:
+            Port.dict_instances.pop(name)
+        self.entities = EntityRegistry([DEFAULT])
+        self.ports_to_move = ScopeStack()
+        self.entities_to_move = ScopeStack()
+        self.spatial_index = {}
+        self._bbox_invalid = {}
+        self.dict_instances.pop(self.name, None)
+
     def __call__(self, pos, ori):
         pos, ori = parse_entry(pos, ori)
         if len(pos)==2:
@@ -161,6 +167,81 @@ class Body(Modeler):
     #     self.cursors.pop(-1)
     #     return False
 
+    ### Spatial queries
+
+    def invalidate_bbox(self, entity):
+        # the bounding box of entity is recomputed at the next query
+        self._bbox_invalid[entity] = None
+
+    def _refresh_index(self):
+        for entity in self._bbox_invalid:
+            index = self.spatial_index.setdefault(entity.layer,
+                                                  SpatialIndex())
+            bbox = None
+            if entity in self.entities[entity.layer]:
+                bbox = entity.bounding_box()
+            if bbox is None:
+                index.remove(entity)
+            else:
+                index.insert(entity, bbox)
+        self._bbox_invalid = {}
+
+    def _indices(self, layer):
+        self._refresh_index()
+        if layer is None:
+            return list(self.spatial_index.values())
+        if layer in self.spatial_index:
+            return [self.spatial_index[layer]]
+        return []
+
+    def _mirror(self, entity, points):
+        # numeric bounding box of entities that are not drawn locally
+        if self.mode != 'gds':
+            entity.mirror_bbox = bbox_of(val(points))
+
+    def query_bbox(self, bbox, layer=None):
+        """
+        Finds the entities whose bounding box overlaps a region.
+
+        Inputs:
+        -------
+        bbox: [[xmin, ymin], [xmax, ymax]] in the body coordinates
+        layer: only search this layer, all layers if None
+
+        Outputs:
+        -------
+        entities: list of Entity
+        """
+        (xmin, ymin), (xmax, ymax) = val(parse_entry(bbox))
+        entities = []
+        for index in self._indices(layer):
+            entities += index.query([[xmin, ymin], [xmax, ymax]])
+        return entities
+
+    def query_overlapping(self, entity, layer=None):
+        """
+        Finds the entities whose bounding box overlaps the one of entity,
+        on layer or on all layers if None.
+        """
+        self._refresh_index()
+        index = self.spatial_index.get(entity.layer)
+        if index is None or entity not in index:
+            return []
+        return [other for other in self.query_bbox(index.bbox(entity), layer)
+                if other is not entity]
+
+    def nearest(self, pos, n=1, layer=None):
+        """
+        Finds the n entities whose bounding box is the closest to pos, on
+        layer or on all layers if None, sorted by distance.
+        """
+        pos = val(parse_entry(pos))
+        found = []
+        for index in self._indices(layer):
+            found += index.nearest(pos, n)
+        found.sort(key=lambda item: item[0])
+        return [entity for distance, entity in found[:n]]
+
     def set_body(func):
         """
         Defines a wrapper/decorator which allows the user to always work in the coordinate system of the chosen chip.
@@ -175,6 +256,7 @@ class Body(Modeler):
 
     ### Basic drawings
 
+    @journaled('body')
     @set_body
     def box(self, pos, size, name='box_0', **kwargs):
         """
@@ -194,7 +276,9 @@ class Body(Modeler):
         name = check_name(Entity, name)
         kwargs['name'] = name
         self.interface.box(pos, size, **kwargs)
-        return Entity(3, self, **kwargs)
+        entity = Entity(3, self, **kwargs)
+        self._mirror(entity, [pos, [p+s for p, s in zip(pos, size)]])
+        return entity
 
     @set_body
     def box_center(self, pos, size, name='box_0', **kwargs):
@@ -215,80 +299,209 @@ class Body(Modeler):
         pos = [p - s/2 for p, s in zip(pos, size)]
         return self.rect(pos, size, name=name, **kwargs)
 
+    @journaled('body')
     @set_body
     def cylinder(self, pos, radius, height, axis, name='cylinder', **kwargs):
         pos, radius, height = parse_entry(pos, radius, height)
         name = check_name(Entity, name)
         kwargs['name'] = name
         self.interface.cylinder(pos, radius, height, axis, **kwargs)
-        return Entity(3, self, **kwargs)
+        entity = Entity(3, self, **kwargs)
+        self._mirror(entity, self._axial_extent(pos, radius, height, axis))
+        return entity
     
+    @journaled('body')
     @set_body
     def cone(self, pos, radius1,radius2, height, axis, name='cone', **kwargs):
         pos, radius1, radius2, height = parse_entry(pos, radius1, radius2, height)
         name = check_name(Entity, name)
         kwargs['name'] = name
         self.interface.cone(pos, radius1, radius2, height, axis, **kwargs)
-        return Entity(3, self, **kwargs)
+        entity = Entity(3, self, **kwargs)
+        radius = radius1 if val(radius1) > val(radius2) else radius2
+        self._mirror(entity, self._axial_extent(pos, radius, height, axis))
+        return entity
 
+    @journaled('body')
     @set_body
     def sphere(self, pos, radius, name='sphere', **kwargs):
         pos, radius = parse_entry(pos, radius)
         name = check_name(Entity, name)
         kwargs['name'] = name
         self.interface.sphere(pos, radius, **kwargs)
-        return Entity(3, self, **kwargs)
+        entity = Entity(3, self, **kwargs)
+        self._mirror(entity, [[p-radius for p in pos], [p+radius for p in pos]])
+        return entity
     
+    @journaled('body')
     @set_body
     def torus(self, pos, majorradius, minorradius, axis, name='torus', **kwargs):
         pos, majorradius, minorradius = parse_entry(pos, majorradius, minorradius)
         name = check_name(Entity, name)
         kwargs['name'] = name
         self.interface.torus(pos, majorradius, minorradius, axis, **kwargs)
-        return Entity(3, self, **kwargs)
+        entity = Entity(3, self, **kwargs)
+        radius = majorradius+minorradius
+        self._mirror(entity, [[p-radius for p in pos], [p+radius for p in pos]])
+        return entity
 
+    @journaled('body')
     @set_body
     def disk(self, pos, radius, axis, name='disk_0', **kwargs):
         pos, radius = parse_entry(pos, radius)
         name = check_name(Entity, name)
         kwargs['name'] = name
+        drawing = ('draw', 'disk', (pos, radius), (axis,))
         if self.mode=='gds':
             pos = val(pos)
             radius = val(radius)
         self.interface.disk(pos, radius, axis, **kwargs)
-        return Entity(2, self, **kwargs)
+        entity = Entity(2, self, **kwargs)
+        entity.record(*drawing)
+        self._mirror(entity, [[p-radius for p in pos], [p+radius for p in pos]])
+        return entity
 
+    @journaled('body')
     @set_body
     def polyline(self, points, closed=True, name='polyline_0', **kwargs):
         points = parse_entry(points)
         name = check_name(Entity, name)
         kwargs['name'] = name
-        i = 0
-        while i < len(points[:-1]):
-            points_equal = [equal_float(val(p0),val(p1))
-                            for p0, p1 in zip(points[i], points[i+1])]
-            if all(points_equal):
-                points.pop(i)
+        if isinstance(points, VectorArray) and points.is_numeric():
+            points, n_removed = points.remove_coinciding()
+            for ii in range(n_removed):
                 print('Warning: Delete two coinciding points on a polyline2D')
-            else:
-                i+=1
+        else:
+            i = 0
+            while i < len(points[:-1]):
+                points_equal = [equal_float(val(p0),val(p1))
+                                for p0, p1 in zip(points[i], points[i+1])]
+                if all(points_equal):
+                    points.pop(i)
+                    print('Warning: Delete two coinciding points on a polyline2D')
+                else:
+                    i+=1
+        drawing = ('draw', 'polyline', (points,), (closed,))
         if self.mode=='gds':
             points = val(points)
         self.interface.polyline(points, closed, **kwargs)
         dim = closed + 1
-        return Entity(dim, self, **kwargs)
+        entity = Entity(dim, self, **kwargs)
+        entity.record(*drawing)
+        self._mirror(entity, points)
+        return entity
 
+    @journaled('body')
+    @set_body
+    def polylines(self, points, closed=True, name='polyline_0', **kwargs):
+        """
+        Draws many polylines at once, much faster than calling polyline for
+        each.
+
+        Inputs:
+        -------
+        points: list of N arrays of shape (M, 2) or (M, 3), numeric points in
+                SI units (as returned by val), M can vary between polylines
+        closed: whether the polylines are closed (polygons)
+        name: name of the first polyline, the following ones are numbered
+              from it
+
+        Outputs:
+        -------
+        entities: list of the N Entity
+        """
+        points_list = []
+        for points_2D in points:
+            points_2D = VectorArray(np.array(points_2D, dtype=float)[:, :2])
+            points_2D, n_removed = points_2D.remove_coinciding()
+            for ii in range(n_removed):
+                print('Warning: Delete two coinciding points on a polyline2D')
+            points_list.append(points_2D.view(np.ndarray)[:, :2])
+        names = check_names(Entity, name, len(points_list))
+        try:
+            func = self.interface.polylines
+        except AttributeError:
+            for points_2D, name in zip(points_list, names):
+                kwargs['name'] = name
+                self.interface.polyline(points_2D.tolist(), closed, **kwargs)
+        else:
+            kwargs['name'] = names
+            func(points_list, closed, **kwargs)
+        entities = []
+        for points_2D, name in zip(points_list, names):
+            kwargs['name'] = name
+            entity = Entity(closed + 1, self, **kwargs)
+            entity.record('draw', 'polyline', (points_2D.tolist(),), (closed,),
+                          dependencies=set())
+            entities.append(entity)
+        if self.mode != 'gds':
+            for entity, points_2D in zip(entities, points_list):
+                entity.mirror_bbox = bbox_of(points_2D)
+        return entities
+
+    @journaled('body')
     @set_body
     def rect(self, pos, size, name='rect_0', **kwargs):
         pos, size = parse_entry(pos, size)
         name = check_name(Entity, name)
         kwargs['name'] = name
+        drawing = ('draw', 'rect', (pos, size), ())
         if self.mode=='gds':
             pos = val(pos)
             size = val(size)
         self.interface.rect(pos, size, **kwargs)
-        return Entity(2, self, **kwargs)
+        entity = Entity(2, self, **kwargs)
+        entity.record(*drawing)
+        self._mirror(entity, [pos, [p+s for p, s in zip(pos, size)]])
+        return entity
 
+    @journaled('body')
+    @set_body
+    def rects(self, pos, size, name='rect_0', **kwargs):
+        """
+        Draws many rectangles at once, much faster than calling rect for each.
+
+        Inputs:
+        -------
+        pos: array of shape (N, 2) or (N, 3), numeric positions of the corners
+             in SI units (as returned by val)
+        size: array of shape (N, 2) or (N, 3), or a single size for all
+        name: name of the first rectangle, the following ones are numbered
+              from it
+
+        Outputs:
+        -------
+        entities: list of the N Entity
+        """
+        if len(pos) == 0:
+            return []
+        pos = np.array(pos, dtype=float)[:, :2]
+        size = np.broadcast_to(np.array(size, dtype=float)[..., :2],
+                               pos.shape)
+        names = check_names(Entity, name, len(pos))
+        try:
+            func = self.interface.rects
+        except AttributeError:
+            for ii, name in enumerate(names):
+                kwargs['name'] = name
+                self.interface.rect(pos[ii].tolist(), size[ii].tolist(),
+                                    **kwargs)
+        else:
+            kwargs['name'] = names
+            func(pos, size, **kwargs)
+        entities = []
+        for ii, name in enumerate(names):
+            kwargs['name'] = name
+            entity = Entity(2, self, **kwargs)
+            entity.record('draw', 'rect', (pos[ii].tolist(), size[ii].tolist()),
+                          (), dependencies=set())
+            entities.append(entity)
+        if self.mode != 'gds':
+            for entity, corner0, corner1 in zip(entities, pos, pos+size):
+                entity.mirror_bbox = bbox_of([corner0, corner1])
+        return entities
+
+    @journaled('body')
     @set_body
     #####draw arrays of rectangles with dimension (colums x row) with spacing given by a list [x_spacing,y_spacing]
     def rect_array(self, pos, size, columns, rows, spacing, name='rect_array_0', **kwargs):
@@ -296,37 +509,88 @@ class Body(Modeler):
             pos, size, spacing = parse_entry(pos, size, spacing)
             name = check_name(Entity, name)
             kwargs['name'] = name
+            entity_args = (pos, size, spacing)
             pos = val(pos)
             size = val(size)
             spacing = val(spacing)
             self.interface.rect_array(pos, size, columns, rows, spacing, **kwargs)
-            return Entity(2, self, **kwargs)
+            entity = Entity(2, self, **kwargs)
+            entity.freeze(*entity_args)
+            return entity
         else:
             pass
 
+    @journaled('body')
+    @set_body
+    def array(self, entity, columns, rows, spacing, name='array_0', **kwargs):
+        """
+        Draws an array of copies of an entity, entity itself is unchanged.
+        In gds mode the array is a single reference to a cell holding the
+        geometry of entity, it is flattened only by booleans and fillets.
+
+        Inputs:
+        -------
+        entity: Entity to be repeated, the first copy is at its position
+        columns, rows: number of copies along x and y
+        spacing: [x_spacing, y_spacing]
+
+        Outputs:
+        -------
+        array: the Entity of all the copies
+        """
+        spacing = parse_entry(spacing)
+        name = check_name(Entity, name)
+        self.apply_moves([entity])
+        if self.mode == 'gds':
+            kwargs['name'] = name
+            kwargs['layer'] = entity.layer
+            self.interface.array(entity, columns, rows, val(spacing),
+                                 **kwargs)
+            array = Entity(entity.dimension, self, nonmodel=entity.nonmodel,
+                           **kwargs)
+            array.freeze(spacing)
+            if entity.dependencies is not None:
+                self.pm.track(array, entity.dependencies)
+            return array
+        copies = []
+        for ii in range(columns):
+            for jj in range(rows):
+                copy = entity.copy()
+                if ii or jj:
+                    copy.translate([ii*spacing[0], jj*spacing[1], 0])
+                copies.append(copy)
+        array = self.pm.unite(copies)
+        array.rename(name)
+        return array
+
     @set_body
     def rect_center(self, pos, size, name='rect_0', **kwargs):
         pos, size = parse_entry(pos, size)
         pos = [p - s/2 for p, s in zip(pos, size)]
         return self.rect(pos, size, name=name, **kwargs)
 
+    @journaled('body')
     @set_body
     def wirebond(self, pos, ori, ymax, ymin, name='wb_0', **kwargs):
         pos, ymax, ymin = parse_entry(pos, ymax, ymin)
         name = check_name(Entity, name)
         kwargs['name'] = name
         if self.mode=='gds':
+            entity_args = (pos, ori, ymax, ymin)
             pos, ori, ymax, ymin = val(pos, ori, ymax, ymin)
             self.interface.wirebond(pos, ori, ymax, ymin, **kwargs)
             kwargs['name'] = name+'a'
             entity_a = Entity(2, self, **kwargs)
+            entity_a.freeze(*entity_args)
             kwargs['name'] = name+'b'
             entity_b = Entity(2, self, **kwargs)
+            entity_b.freeze(*entity_args)
             return entity_a, entity_b
         else:
             self.interface.wirebond(pos, ori, ymax, ymin, **kwargs)
             return Entity(3, self, **kwargs)
 
+    @journaled('body')
     @set_body
     def path(self, points, port, fillet, name='path_0', **kwargs):
         #fillet should be either 0 or larger than half of the port width
@@ -334,26 +598,27 @@ class Body(Modeler):
         kwargs['name'] = name
         model_entities = []
         if self.mode == 'gds':
-            points = val(points)
+            drawing = (list(points), list(port.widths), list(port.offsets),
+                       list(port.layers), list(port.subnames), fillet)
+            points = VectorArray(val(points))
             fillet = val(fillet)
             _port = port.val()
 
-            #TODO, this is a dirty fixe cause of Vector3D
-
             # due to the 3D vector implementation
-            points_2D = []
-            for point in points:
-                points_2D.append([point[0], point[1]])
+            points_2D = points[:, :2]
 
             if fillet==0:
-                names, layers = self.interface.path(points_2D, _port, fillet, name=name, corner="natural")
+                corner = "natural"
             else:
-                names, layers = self.interface.path(points_2D, _port, fillet, name=name, corner="circular bend")
+                corner = "circular bend"
+            names, layers = self.interface.path(points_2D, _port, fillet, name=name, corner=corner)
 
-            for name, layer in zip(names, layers):
+            for ii, (name, layer) in enumerate(zip(names, layers)):
                 kwargs['layer'] = layer
                 kwargs['name'] = name
-                model_entities.append(Entity(2, self, **kwargs))
+                entity = Entity(2, self, **kwargs)
+                entity.record('path', *drawing, corner, ii)
+                model_entities.append(entity)
         elif self.mode == 'hfss':
             # check that port is at the BEGINNING of the path (hfss only)
             ori = Vector(port.ori)
@@ -393,9 +658,22 @@ class Body(Modeler):
                 model_entities.append(entity)
                 #here the path is added to the entities, not the port -> problem ?
 
+        if self.mode != 'gds':
+            half_width = max(abs(val(offset))+val(width)/2 for offset, width
+                             in zip(port.offsets, port.widths))
+            (xmin, ymin), (xmax, ymax) = bbox_of(val(points))
+            for entity in model_entities:
+                entity.mirror_bbox = [[xmin-half_width, ymin-half_width],
+                                      [xmax+half_width, ymax+half_width]]
 
         return model_entities
 
+    def _axial_extent(self, pos, radius, height, axis):
+        # two corners of the bounding box of a body of revolution
+        direction = {'X': [1, 0, 0], 'Y': [0, 1, 0], 'Z': [0, 0, 1]}[axis]
+        return [[p-radius*(1-d) for p, d in zip(pos, direction)],
+                [p+radius*(1-d)+height*d for p, d in zip(pos, direction)]]
+
     ### Advanced methods
 
     def move_port(func):
@@ -418,9 +696,10 @@ class Body(Modeler):
         def moved(*args, **kwargs):
             new_args = [args[0]]  # args[0] = chip, args[1] = name
             for i, argument in enumerate(args[1:]):
-                if isinstance(argument, str) and (argument in Port.dict_instances):
+                if isinstance(argument, str) and \
+                        Port.find(argument) is not None:
                     #  if argument is the sting representation of the port
-                    new_args.append(Port.dict_instances[argument])
+                    new_args.append(Port.find(argument))
                 elif isinstance(argument, Port):
                     #  it the argument is the port itself
                     new_args.append(argument)
@@ -584,14 +863,13 @@ class Body(Modeler):
         if do_not_beyong:
             raise ValueError('%s ports do not beyond to %s'%(do_not_beyong, self))
 
-        indent_level = find_corresponding_list(ports[0], self.ports_to_move)
+        indent_level = self.ports_to_move.scope_of(ports[0])
         if indent_level is not None:
-            if indent_level:  # the found list
-                for port in ports:
-                    if not port in indent_level:
-                        msg = 'Trying to connect ports from different \
-                                indentation levels: port %s'%(port.name)
-                        raise IndentationError(msg)
+            for port in ports:
+                if self.ports_to_move.scope_of(port) is not indent_level:
+                    msg = 'Trying to connect ports from different \
+                            indentation levels: port %s'%(port.name)
+                    raise IndentationError(msg)
 
         # asserts neither in nor out port are constraint_ports
         if ports[0].constraint_port and ports[-1].constraint_port:
@@ -761,6 +1039,7 @@ class Body(Modeler):
                 pos = pos + ori*spacing
             jj+=1
             
+    @journaled('body')
     @set_body
     def text(self, pos, size, text, angle=0, horizontal=True, name="text_0", **kwargs):
         """
@@ -776,9 +1055,12 @@ class Body(Modeler):
             pos, size = parse_entry(pos, size)
             name = check_name(Entity, name)
             kwargs["name"] = name
+            drawing = ('draw', 'text', (pos, size), (text, angle, horizontal))
             pos = val(pos)
             size = val(size)
             self.interface.text(pos, size, text, angle, horizontal, **kwargs)
-            return Entity(2, self, **kwargs)
+            entity = Entity(2, self, **kwargs)
+            entity.record(*drawing)
+            return entity
         else:
             pass
\ No newline at end of file
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+On disk cache of the gds cells, addressed by a hash of everything the cell
+is drawn from, see Modeler.generate_gds.
+"""
+
+import hashlib
+import json
+import os
+
+# bump when the drawing code changes the output for the same operations
+CACHE_VERSION = 2
+
+class BuildCache():
+    """
+    Directory of files named by the hash of their inputs, evicted in least
+    recently used order when their total size exceeds max_size (bytes).
+
+    Inputs:
+    -------
+    directory: created if it does not exist
+    max_size: size in bytes above which the least recently used files are
+              deleted, default 1 GB
+    """
+
+    def __init__(self, directory, max_size=2**30):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*inputs):
+        # hash of json compatible inputs
+        content = json.dumps([CACHE_VERSION, inputs], sort_keys=True,
+                             separators=(',', ':'))
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        # cached bytes or None, a hit makes the file the most recently used
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        # written aside and renamed to never expose a partial file to
+        # concurrent builds
+        tmp_path = '%s.%d.tmp'%(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.is_file() and not entry.name.endswith('.tmp'))
+
+    def evict(self):
+        entries = [entry for entry in os.scandir(self.directory)
+                   if entry.is_file() and not entry.name.endswith('.tmp')]
+        stats = sorted(((entry.stat().st_mtime, entry.stat().st_size,
+                         entry.path) for entry in entries))
+        size = sum(stat[1] for stat in stats)
+        for mtime, file_size, path in stats:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
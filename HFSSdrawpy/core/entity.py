@@ -4,14 +4,18 @@ import numpy as np
 
 from ..parameters import DEFAULT
 
-from ..utils import Vector, parse_entry, check_name, find_last_list, \
-    add_to_corresponding_list, gen_name, val, general_remove
+from .journal import journaled
+from ..utils import Vector, parse_entry, check_name, gen_name, \
+    gen_free_name, val, NameRegistry, free_symbols
 
 class Entity():
     """ Entity of th HFSS class """
     # this should be the objects we are handling on the python interface
     # each method of this class should act in return in HFSS/GDS when possible
-    dict_instances = {}
+    dict_instances = NameRegistry()
+    __slots__ = ('name', 'dimension', 'body', 'nonmodel', 'layer',
+                 'pending_move', 'is_boolean', 'is_fillet', 'history',
+                 'dependencies', 'mirror_bbox', '_names_used')
 
     def __init__(self, dimension, body, nonmodel=False, layer=DEFAULT,
                  copy=None, name='entity_0', **kwargs):
@@ -21,27 +25,47 @@ class Entity():
         self.body = body
         self.nonmodel = nonmodel
         self.layer = layer
+        # (angle, vector) of the enclosing 'with body(pos, ori)' scopes that
+        # is not applied in the interface yet, see Modeler.apply_moves
+        self.pending_move = None if copy is None else copy.pending_move
 
         Entity.dict_instances[name] = self
-        if layer in self.body.entities.keys():
-            self.body.entities[layer].append(self)
-        else:
-            self.body.entities[layer]=[self]
-
+        self.body.entities.add(self)
+        self.body.invalidate_bbox(self)
+
+        # history: operations drawing the entity, replayed by
+        # Modeler.rebuild when a variable the entity depends on changes
+        # (gds only), None if the entity cannot be rebuilt
+        # dependencies: symbols of the variables used by these operations,
+        # None if the entity is not tracked
         if copy is None:
-            if self.body.entities_to_move is not None:
-                find_last_list(self.body.entities_to_move).append(self)
+            self.body.entities_to_move.add(self)
             self.is_boolean = False  # did it suffer a bool operation already ?
             self.is_fillet = False  # did it suffer a fillet operation already ?
+            if body.mode == 'gds':
+                self.history = []
+                self.dependencies = set()
+            else:
+                self.history = None
+                self.dependencies = None
+            # numeric bounding box maintained by the body when the geometry
+            # is not drawn locally (hfss and comsol modes)
+            self.mirror_bbox = None
         else:
             # copy is indeed the original object
             # the new object should be put in the same list indent
-            add_to_corresponding_list(copy, self.body.entities_to_move,
-                                      self)
+            self.body.entities_to_move.add_next_to(copy, self)
             self.is_boolean = copy.is_boolean
             self.is_fillet = copy.is_fillet
-        
-        self._names_used = []
+            self.history = None if copy.history is None else list(copy.history)
+            self.mirror_bbox = copy.mirror_bbox
+            if copy.dependencies is None:
+                self.dependencies = None
+            else:
+                self.dependencies = set()
+                self.body.pm.track(self, copy.dependencies)
+
+        self._names_used = None  # created by duplicate_along_line
 
     def __str__(self):
         return self.name
@@ -65,22 +89,55 @@ class Entity():
 
     ### Modifying methods
 
+    @journaled('entity')
     def delete(self):
         # deletes the Entity and its occurences throughout the code
         # it does not delete the entity Python object anymore
         self.body.interface.delete(self)
+        self.body.pm.untrack(self)
         self.dict_instances.pop(self.name)
-        self.body.entities[self.layer].remove(self)
-        if self.body.entities_to_move is not None:
-            general_remove(self, self.body.entities_to_move)
+        self.body.entities.remove(self)
+        self.body.entities_to_move.remove(self)
+        self.body.invalidate_bbox(self)
 
+    def record(self, *operation, dependencies=None):
+        """
+        Appends operation to the history of the entity and tracks the
+        variables it depends on, which are found in operation unless the
+        set of their symbols is given as dependencies.
+        Operations are tuples starting with their kind:
+            ('draw', interface method, geometric args, other args)
+            ('path', points, widths, offsets, layers, subnames, fillet,
+             corner, index of the drawn part)
+            ('rotate', angle)
+            ('translate', vector)
+            ('fillet', radius, vertex_indices)
+            ('unite' or 'subtract', [(tool layer, tool history), ...])
+        """
+        if self.dependencies is None:
+            return
+        if self.history is not None:
+            self.history.append(operation)
+        if dependencies is None:
+            dependencies = free_symbols(operation)
+        self.body.pm.track(self, dependencies)
+
+    def freeze(self, *entries):
+        """
+        The entity cannot be rebuilt by replaying its history anymore. The
+        variables appearing in entries are still tracked to warn the user
+        when they change.
+        """
+        if self.dependencies is None:
+            return
+        self.history = None
+        self.body.pm.track(self, free_symbols(entries))
+
+    @journaled('entity')
     def copy(self, new_name=None):
-        generated_name = gen_name(self.name)
-        while generated_name in self.dict_instances:
-            generated_name = gen_name(generated_name)
-            
-        #self.body.interface.copy(self, name=generated_name)
-        self.body.interface.copy(self)
+        generated_name = gen_free_name(self.__class__, self.name)
+
+        self.body.interface.copy(self, name=generated_name)
         copied = Entity(self.dimension, self.body,
                              nonmodel=self.nonmodel, layer=self.layer,
                              copy=self, name=generated_name)
@@ -88,27 +145,45 @@ class Entity():
             copied.rename(new_name)
         return copied
 
+    @journaled('entity')
     def rename(self, new_name):
         self.dict_instances.pop(self.name)
         self.dict_instances[new_name] = self
         self.body.interface.rename(self, new_name)
         self.name = new_name
 
+    def bounding_box(self):
+        """
+        Returns the bounding box [[xmin, ymin], [xmax, ymax]] of the entity
+        in the coordinates of its body, or None if unknown.
+        In hfss and comsol modes it is computed from the drawing parameters
+        and is larger than the actual geometry after rotations or booleans.
+        """
+        self.body.apply_moves([self])
+        if self.body.mode == 'gds':
+            return self.body.interface.get_bounding_box(self)
+        return self.mirror_bbox
+
+    @journaled('entity')
     def thicken_sheet(self, thickness, bothsides=False):
         self.body.interface.thicken_sheet(self, thickness, bothsides=False)
 
+    @journaled('entity')
     def assign_perfect_E(self, suffix='perfE'):
         self.body.interface.assign_perfect_E(self, self.name+'_'+suffix)
 
+    @journaled('entity')
     def assign_waveport(self, Nmodes=1, DoRenorm=False, RenormValue="50ohm", DoDeembed=False, DeembedDist="0mm", prefix='port'):
         self.body.interface.assign_waveport(self, prefix+'_'+self.name, Nmodes, DoRenorm, RenormValue, DoDeembed, DeembedDist)
 
+    @journaled('entity')
     def assign_terminal_auto(self, ground, prefix='port'):
         self.body.interface.assign_terminal_auto(self, prefix+'_'+self.name, ground)
 
     def connect_faces(self, name, entity1, entity2):
         raise NotImplementedError()
 
+    @journaled('entity')
     def duplicate_along_line(self, vec, n=None) -> Union[Entity, List[Entity]]:
         nn = 1 if n is None else n
         # print("soooo")
@@ -121,6 +196,8 @@ class Entity():
             for i in range(nn):
                 copy = self.copy() #new_name=self.name + "_duplicate%i"%i)
                 copy.translate([(i+1)*coord for coord in vec])
+                if self._names_used is None:
+                    self._names_used = []
                 ii = i
                 while ((self.name + "_duplicate%i"%ii) in self._names_used):
                     ii+=1
@@ -130,6 +207,7 @@ class Entity():
                 copies.append(copy)
             return copies if n is not None else copies[0]
         else:
+            self.body.apply_moves([self])
             copies = []
             list_of_names = func(self, vec, nn+1)
             print(f"list_of_names = {list_of_names}")
@@ -142,12 +220,14 @@ class Entity():
             return copies if n is not None else copies[0]
             
     def find_vertex(self):
+        self.body.apply_moves([self])
         vertices = self.body.interface.get_vertices(self)
         return vertices
     
     def find_start_vertex(self):
         # finds the lowest vertex in Y in a polygon
         # if there are several, returns the lowest in X
+        self.body.apply_moves([self])
         vertices = self.body.interface.get_vertices(self)
         min_y = vertices[0][1]
         min_x = vertices[0][0]
@@ -179,18 +259,21 @@ class Entity():
         is_trigo = angle_p > angle_n
         return result_index, len(vertices), is_trigo
 
+    @journaled('entity')
     def fillet(self, radius, vertex_indices=None):
         # print(vertex_indices)
         # assert (not self.is_fillet), 'Cannot fillet an already filleted entity'
 
         if self.body.mode == "comsol" and vertex_indices != None:
             return None
+        self.body.invalidate_bbox(self)
 
         if vertex_indices is None:
             # filleting all vertices
             msg = 'Should provide a single radius when filleting all vertices'
             assert not isinstance(radius, list), msg
             if self.body.mode=='gds':
+                self.record('fillet', radius, None)
                 radius = val(radius)
             self.body.interface.fillet(self, radius)
             self.is_fillet = True
@@ -231,6 +314,7 @@ class Entity():
         msg = 'Vertex index is present more than once in fillet'
         assert len(flat_indices)==len(set(flat_indices)), msg
         if self.body.mode=='gds':
+            self.record('fillet', radius, vertex_indices)
             radius = val(radius)
             self.body.interface.fillet(self, radius, vertex_indices)
         else:
@@ -317,17 +401,21 @@ class Entity():
 
 
 
+    @journaled('entity')
     def assign_material(self, material):
         self.body.interface.assign_material(self, material)
 
+    @journaled('entity')
     def assign_impedance(self, ResistanceSq, ReactanceSq,  name="impedance"):
         self.body.interface.assign_impedance(self, ResistanceSq, ReactanceSq, name)
 
 
+    @journaled('entity')
     def assign_mesh_length(self, mesh_length):
         mesh_length = parse_entry(mesh_length)
         self.body.interface.assign_mesh_length(self, mesh_length)
 
+    @journaled('entity')
     def assign_lumped_RLC(self, points, rlc):
 
         points = parse_entry(points)
@@ -374,6 +462,7 @@ class Entity():
 
         r, l, c = rlc
 
+        self.body.apply_moves([self])
         self.body.interface.assign_lumped_rlc(self, r, l, c, point_0,
                                               point_1, name="RLC")
 
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Journal of the operations sent by a Modeler to its interface, which can be
+saved and replayed against any interface without running the drawing
+script again.
+"""
+
+import json
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+
+import numpy as np
+import sympy
+
+from ..utils import compose_move, NameRegistry, LayerView
+
+JOURNAL_VERSION = 1
+
+def journaled(target):
+    """
+    Decorator recording the calls of a method of target ('modeler', 'body'
+    or 'entity') in the journal of the Modeler. Only the outermost calls are
+    recorded, the calls they make themselves are replayed with them.
+    """
+    def decorator(func):
+        @wraps(func)
+        def recorded(self, *args, **kwargs):
+            journal = (self.body if target == 'entity' else self).journal
+            if journal.depth > 0:
+                return func(self, *args, **kwargs)
+            # arguments are encoded before the call which may modify them
+            name = None if target == 'modeler' else self.name
+            operation = [target, name, func.__name__, _encode(list(args)),
+                         _encode(kwargs)]
+            with journal.suspended():
+                result = func(self, *args, **kwargs)
+            journal.operations.append(operation)
+            return result
+        return recorded
+    return decorator
+
+@lru_cache(maxsize=None)
+def _classes():
+    # imported late, the core modules import this one
+    from .entity import Entity
+    from .port import Port
+    from .body import Body
+    return Entity, Port, Body
+
+@lru_cache(maxsize=None)
+def _srepr(expr):
+    # the same variables and expressions are encoded over and over
+    return sympy.srepr(expr)
+
+def _encode(value):
+    # json compatible version of value, entities and ports are referred to
+    # by their name
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_encode(elt) for elt in value]
+    Entity, Port, Body = _classes()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, Entity):
+        return {'entity': value.name}
+    if isinstance(value, Body):
+        return {'body': value.name}
+    if isinstance(value, Port):
+        return {'port': [value.body.name, value.name, _encode(value.pos),
+                         _encode(value.ori), _encode(value.widths),
+                         value.subnames, value.layers, _encode(value.offsets),
+                         value.constraint_port]}
+    if isinstance(value, sympy.Basic):
+        return {'expr': _srepr(value)}
+    if isinstance(value, (np.ndarray, LayerView)):
+        return [_encode(elt) for elt in value]
+    if isinstance(value, dict):
+        return {'dict': [[_encode(key), _encode(elt)]
+                         for key, elt in value.items()]}
+    return {'unknown': repr(value)}
+
+class _Missing(Exception):
+    pass
+
+def _decode(value, pm):
+    if isinstance(value, list):
+        return [_decode(elt, pm) for elt in value]
+    if not isinstance(value, dict):
+        return value
+    Entity, Port, Body = _classes()
+    if 'entity' in value:
+        if value['entity'] not in Entity.dict_instances:
+            raise _Missing("entity '%s' does not exist"%value['entity'])
+        return Entity.dict_instances[value['entity']]
+    if 'body' in value:
+        return Body.dict_instances[value['body']]
+    if 'port' in value:
+        body, name, pos, ori, widths, subnames, layers, offsets, \
+            constraint_port = _decode(value['port'], pm)
+        return Port(Body.dict_instances[body], name, pos, ori, widths,
+                    subnames, layers, offsets, constraint_port, key=None)
+    if 'expr' in value:
+        return sympy.sympify(value['expr'])
+    if 'dict' in value:
+        return {_decode(key, pm): _decode(elt, pm)
+                for key, elt in value['dict']}
+    raise _Missing('%s cannot be replayed'%value['unknown'])
+
+class Journal():
+    """
+    Operations of a Modeler, in order: creation of the bodies, variables,
+    drawings, booleans, moves, fillets and boundary assignments.
+
+    The journal is recorded whatever the mode and can be replayed against
+    the gds, hfss or comsol interface. A replay only calls the drawing
+    primitives, so it is much cheaper than the script that produced it
+    (path finding, cables, ports...).
+
+    Some drawings give differently named entities depending on the mode
+    (e.g. gds wirebonds and paths), operations referring to entities that
+    do not exist in the replay are skipped with a warning.
+    """
+
+    def __init__(self, operations=None):
+        # [target, name, method, args, kwargs], target being 'modeler',
+        # 'body' or 'entity', name the name of the body or entity
+        self.operations = [] if operations is None else operations
+        self.depth = 0  # > 0 while a recorded operation is executed
+
+    def __len__(self):
+        return len(self.operations)
+
+    @contextmanager
+    def suspended(self):
+        # operations executed in this context are not recorded
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+    def record_body(self, name, rel_coor, ref_name):
+        if self.depth == 0:
+            self.operations.append(['modeler', None, 'body',
+                                    _encode([name, rel_coor, ref_name]),
+                                    _encode({})])
+
+    def record_move(self, body, entities, ori, pos, outermost):
+        # move of the entities at the exit of a 'with body(pos, ori)' scope
+        if self.depth == 0 and entities:
+            names = [entity.name for entity in entities]
+            self.operations.append(['body', body.name, 'move',
+                                    _encode([names, ori, pos, outermost]),
+                                    _encode({})])
+
+    def save(self, file):
+        with open(file, 'w') as f:
+            json.dump({'version': JOURNAL_VERSION,
+                       'operations': self.operations}, f)
+
+    @classmethod
+    def load(cls, file):
+        with open(file) as f:
+            content = json.load(f)
+        if content['version'] != JOURNAL_VERSION:
+            raise ValueError('Unsupported journal version %s'
+                             %content['version'])
+        return cls(content['operations'])
+
+    def replay(self, mode):
+        """
+        Replays the journal against a new Modeler in mode ('gds', 'gdstk',
+        'hfss' or 'comsol') and returns this Modeler, e.g. to call
+        generate_gds.
+
+        The instances of the current run are kept aside during the replay.
+        """
+        from .modeler import Modeler
+        from .entity import Entity
+        from .port import Port
+        from .body import Body
+        saved = (Entity.dict_instances, Port.dict_instances,
+                 Body.dict_instances)
+        Entity.dict_instances = NameRegistry()
+        Port.dict_instances = NameRegistry()
+        Body.dict_instances = {}
+        try:
+            pm = Modeler(mode)
+            if mode == 'gds':
+                # the gds objects of the current run are kept aside too
+                pm.interface.gds_object_instances = {}
+                pm.interface.gds_cells = {}
+            with pm.journal.suspended():
+                for operation in self.operations:
+                    self._replay_operation(pm, *operation)
+                for body in pm.bodies:
+                    body.apply_moves(body.entities.all())
+            pm.journal.operations = list(self.operations)
+        finally:
+            Entity.dict_instances, Port.dict_instances, \
+                Body.dict_instances = saved
+        return pm
+
+    def _replay_operation(self, pm, target, name, method, args, kwargs):
+        from .entity import Entity
+        from .body import Body
+        try:
+            args = _decode(args, pm)
+            kwargs = _decode(kwargs, pm)
+            if target == 'modeler':
+                if method == 'body':
+                    Body(pm, *args)
+                    return
+                obj = pm
+            elif target == 'body':
+                obj = Body.dict_instances[name]
+                if method == 'move':
+                    names, ori, pos, outermost = args
+                    entities = [Entity.dict_instances[name] for name in names
+                                if name in Entity.dict_instances]
+                    for entity in entities:
+                        entity.pending_move = compose_move(entity.pending_move,
+                                                           ori, pos)
+                    if outermost:
+                        obj.apply_moves(entities)
+                    return
+            else:
+                if name not in Entity.dict_instances:
+                    raise _Missing("entity '%s' does not exist"%name)
+                obj = Entity.dict_instances[name]
+            getattr(obj, method)(*args, **kwargs)
+        except _Missing as error:
+            print('Warning: %s is skipped, %s'%(method, error))
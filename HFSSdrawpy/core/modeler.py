@@ -5,16 +5,18 @@ Created on Thu Oct 31 14:14:51 2019
 @author: antho
 """
 
-from pint import UnitRegistry
 import numpy as np
 import os
+from contextlib import contextmanager
 from inspect import currentframe, getfile
 import sympy
 
 from .entity import Entity
-from ..utils import variables, store_variable, parse_entry, val
-
-sympy.init_printing(use_latex=False)
+from .journal import Journal, journaled, _encode
+from .cache import BuildCache
+from ..utils import variables, store_variables, parse_entry, val, \
+    parse_value, sympy_exprs, val_sweep, rotate_bbox, translate_bbox, \
+    union_bbox
 
 class Modeler():
     """
@@ -27,7 +29,7 @@ class Modeler():
 
     Inputs:
     -------
-    mode: string in "gds" or "hfss"
+    mode: string in "gds", "gdstk", "hfss" or "comsol"
     """
     is_overdev = False
     is_litho = False
@@ -35,11 +37,27 @@ class Modeler():
     gap_mask = parse_entry('20um')
     overdev = parse_entry('0um')
 
-    def __init__(self, mode):
+    def __init__(self, mode, instancing=False, processes=1):
         """
         Creates a Modeler object based on the chosen interface.
         For now the interface cannot be changed during an execution, only at the beginning
+
+        In gds mode, instancing=True draws the copies of an entity (copy,
+        duplicate_along_line) as references to a single cell holding its
+        geometry, they are flattened when a boolean or a fillet needs their
+        polygons.
+        processes sets the number of worker processes evaluating the gds
+        booleans of several blanks and fracturing the polygons at export,
+        1 (default) runs them in this process and None uses all the cores.
+        The workers are stopped by pm.interface.close() or when the Modeler
+        is garbage collected.
+
+        The "gdstk" mode draws the same gds files with gdstk instead of
+        gdspy, with faster booleans and fracturing on large designs. It is
+        otherwise the gds mode (self.mode is "gds"), except that sweep is
+        not available and processes is not used.
         """
+        sympy.init_printing(use_latex=False)
         self.mode = mode
         if mode == "hfss":
             from ..interfaces.hfss_modeler import get_desktop
@@ -54,18 +72,31 @@ class Modeler():
             self.interface = self.modeler
         elif mode=="gds":
             from ..interfaces import gds_modeler
-            self.interface = gds_modeler.GdsModeler()
+            self.interface = gds_modeler.GdsModeler(instancing=instancing,
+                                                    processes=processes)
+        elif mode=="gdstk":
+            from ..interfaces import gdstk_modeler
+            self.interface = gdstk_modeler.GdstkModeler(instancing=instancing)
+            self.mode = "gds"
         elif mode=="comsol":
             from ..interfaces import comsol_modeler
             self.interface = comsol_modeler.ComsolModeler(number_of_cores=1, 
                                                           save_path=None, 
                                                           gui=False)
         else:
-            print('Mode should be either hfss, gds, or comsol')
+            print('Mode should be either hfss, gds, gdstk, or comsol')
 
         #The list of bodies pointing to the current Modeler
         self.bodies = []
 
+        # dependency graph {symbol: {entity: None}} of the entities whose
+        # geometry depends on each variable
+        self.dependents = {}
+
+        # operations of the run, which can be saved and replayed against
+        # another interface
+        self.journal = Journal()
+
     ### Utils methods
 
     def delete_all_objects(self, entities):
@@ -86,36 +117,260 @@ class Modeler():
             code_line = open(filename).readlines()[f.f_lineno - 1]
             name = code_line.split("=")[0].strip()
 
-        if self.mode == 'hfss':
-            self.design.set_variable(name, value)  # for HFSS
+        return self.set_variables({name: value})[0]
 
-        if self.mode == 'comsol':
-            self.interface.set_variable(name, value) # for COMSOL
+    @journaled('modeler')
+    def set_variables(self, assignments):
+        """
+        Sets several variables at once, which is faster than calling
+        set_variable for each of them.
 
-        symbol = sympy.symbols(name)
-        store_variable(symbol, value)
-        return symbol
+        Inputs:
+        -------
+        assignments: {name (str): value (str, VarStr, float)}
 
-    def generate_gds(self, folder, filename, max_points=0):
+        Outputs:
+        -------
+        symbols: list of the sympy symbols of the variables
+        """
+        for name, value in assignments.items():
+            if self.mode == 'hfss':
+                self.design.set_variable(name, value)  # for HFSS
+
+            if self.mode == 'comsol':
+                self.interface.set_variable(name, value) # for COMSOL
+
+        symbols = [sympy.symbols(name) for name in assignments]
+        modified = store_variables(dict(zip(symbols, assignments.values())))
+        modified = [symbol for symbol in modified if symbol in self.dependents]
+        if modified:
+            self.rebuild(modified)
+        return symbols
+
+    def track(self, entity, symbols):
+        for symbol in symbols:
+            entity.dependencies.add(symbol)
+            self.dependents.setdefault(symbol, {})[entity] = None
+
+    def untrack(self, entity):
+        if entity.dependencies is not None:
+            for symbol in entity.dependencies:
+                self.dependents[symbol].pop(entity, None)
+        entity.dependencies = None
+        entity.history = None
+
+    def rebuild(self, symbols):
+        """
+        Redraws the entities depending on the variables symbols with the
+        current values of the variables, the other entities are left
+        untouched. Only the gds interface needs it, hfss and comsol handle
+        the variables themselves.
+        """
+        if self.mode != 'gds':
+            return
+        entities = {}
+        for symbol in symbols:
+            entities.update(self.dependents.get(symbol, {}))
+        for entity in entities:
+            if entity.history is None:
+                print('Warning: %s cannot be rebuilt, rerun the script to \
+update it'%entity.name)
+            else:
+                self.interface.rebuild(entity)
+                entity.body.invalidate_bbox(entity)
+
+    def generate_gds(self, folder, filename, max_points=0, cache=None,
+                     report=False, single_file=False, strips=False):
+        """
+        Writes the gds files of the design.
+
+        Inputs:
+        -------
+        folder, filename: one file per body, filename_bodyname.gds, if
+                          there are several
+        max_points: maximum number of points of the written polygons, 0
+                    means no limit
+        cache: BuildCache or directory of one, the bodies whose operations
+               and variable values did not change since a previous build
+               are copied from the cache
+        report: prints the fracture time and the number of polygons and
+                vertices written per layer
+        single_file: if True, all the bodies are written in filename.gds,
+                     the cache is not used
+        strips: if True, the polygons with many more than max_points points
+                (typically ground planes) are cut in strips before being
+                fractured, much faster but the pieces differ from those of
+                the default fracture (their union is the same)
+        The files, or the parts of the single file, are written by the
+        processes of the Modeler if it was created with processes != 1.
+        """
         file = os.path.join(folder, filename)
         if self.mode=='gds':
-            self.interface.generate_gds(file, max_points)
+            if cache is None or single_file:
+                self.interface.generate_gds(file, max_points, report=report,
+                                            single_file=single_file,
+                                            strips=strips)
+                return
+            if isinstance(cache, str):
+                cache = BuildCache(cache)
+            inputs = {body.name: self._cache_inputs(body)
+                      for body in self.bodies}
+            self.interface.generate_gds(file, max_points, cache=cache,
+                                        inputs=inputs, report=report,
+                                        strips=strips)
+
+    @contextmanager
+    def stream_gds(self, folder, filename, max_points=0, strips=False):
+        """
+        Writes the bodies in a single gds file as soon as they are finished,
+        so that the memory used does not grow with the whole layout:
+
+            with pm.stream_gds(folder, 'wafer'):
+                for ii in range(100):
+                    chip = Body(pm, 'chip%d'%ii)
+                    ... # draws chip
+                    pm.write_body(chip)
+
+        The bodies not written by write_body are written when the context
+        exits. Only the gds mode writes files. The journal does not record
+        the operations made within the context, it would otherwise keep
+        growing with the layout.
+
+        Inputs:
+        -------
+        folder, filename: the file is filename.gds
+        max_points: maximum number of points of the written polygons, 0
+                    means no limit
+        strips: see generate_gds
+        """
+        if self.mode == 'gds':
+            self.interface.open_stream(os.path.join(folder, filename),
+                                       max_points, strips)
+        try:
+            with self.journal.suspended():
+                yield self
+                for body in list(self.bodies):
+                    self.write_body(body)
+        finally:
+            if self.mode == 'gds':
+                self.interface.close_stream()
+
+    def write_body(self, body):
+        """
+        Writes body in the file opened by stream_gds and releases its
+        entities, ports and polygons. Nothing can be drawn in body anymore.
+        """
+        if self.mode == 'gds':
+            self.interface.write_cell(body.name)
+        for entity in body.entities.all():
+            self.untrack(entity)
+            Entity.dict_instances.pop(entity.name, None)
+        body.release()
+        self.bodies.remove(body)
+
+    def _cache_inputs(self, body):
+        # everything the cell of body is drawn from: the history of its
+        # entities and the values of the variables they use, or their
+        # polygons when they have no history
+        inputs = [body.name]
+        for entity in body.entities.all():
+            if entity.history is None:
+                geometry = self.interface.digest(entity)
+            else:
+                geometry = _encode(entity.history)
+            values = sorted([str(symbol), float(val(symbol))]
+                            for symbol in entity.dependencies or ())
+            inputs.append([entity.name, entity.layer, geometry, values])
+        return inputs
+
+    def sweep(self, assignments, folder, filename, max_points=0,
+              processes=None):
+        """
+        Writes one gds file per assignment of the variables without running
+        the drawing script again: the geometry drawn so far is evaluated for
+        all the assignments at once and the files are written by a pool of
+        processes.
+
+        Inputs:
+        -------
+        assignments: {variable name or symbol: list of n values}
+        folder, filename: the variant ii is written in folder/filename_ii
+        max_points: see generate_gds
+        processes: number of worker processes, default is the number of cores,
+                   1 writes the variants in this process. The workers may
+                   import the drawing script again (always on Windows and
+                   macOS), which must then draw under
+                   if __name__ == '__main__':
+
+        Outputs:
+        -------
+        files: list of the n file names (without the .gds extension)
+        """
+        if self.mode != 'gds':
+            raise NotImplementedError('sweep is only available in gds mode')
+        swept = {}
+        for name, values in assignments.items():
+            symbol = sympy.symbols(name) if isinstance(name, str) else name
+            swept[symbol] = np.array([parse_value(value) for value in values],
+                                     dtype=float)
+        lengths = set(len(values) for values in swept.values())
+        if len(lengths) != 1:
+            raise ValueError('All the variables should be given the same \
+number of values')
+        n = lengths.pop()
+
+        entities = []
+        for body in self.bodies:
+            for entity in body.entities.all():
+                if entity.history is not None:
+                    entities.append(entity)
+                elif entity.dependencies is not None and \
+                        entity.dependencies & set(swept):
+                    print('Warning: %s cannot be rebuilt, it keeps its \
+current geometry in the sweep'%entity.name)
+        exprs = sympy_exprs([entity.history for entity in entities])
+        values = val_sweep(exprs, swept)
+
+        files = [os.path.join(folder, filename+'_%d'%ii) for ii in range(n)]
+        self.interface.sweep(entities, exprs, values, swept, files,
+                             max_points, processes=processes)
+        return files
 
     def make_material(self, material_params, name):
         raise NotImplementedError()
 
     ### Methods acting on list of entities
 
+    def apply_moves(self, entities):
+        """
+        Applies the pending moves of the 'with body(pos, ori)' scopes to the
+        entities, with a single rotation and translation per distinct move.
+        """
+        moves = {}
+        for entity in entities:
+            if entity.pending_move is not None:
+                moves.setdefault(entity.pending_move, []).append(entity)
+                entity.pending_move = None
+        # the moves are journaled when the scopes exit
+        with self.journal.suspended():
+            for (angle, vector), moved in moves.items():
+                if angle != 0:
+                    self.rotate(moved, angle=angle)
+                if any(coor != 0 for coor in vector):
+                    self.translate(moved, vector=list(vector))
+
     def intersect(self, entities, keep_originals = False):
         raise NotImplementedError()
 
+    @journaled('modeler')
     def unite(self, entities, main=None, keep_originals=False, new_name=None):
         # main: name or entity that should be returned/preserved/final union
         # if new_name (str) is provided, the original entities are kept and
         # the union is named new_name
-        if not isinstance(entities, list):
+        if isinstance(entities, Entity):
             entities = [entities]
-        entities = entities.copy()
+        entities = list(entities)
+        self.apply_moves(entities)
 
         # if new_name is None:
         #     keep_originals = False
@@ -138,7 +393,12 @@ class Modeler():
                 if keep_originals:
                     entities[0] = entities[0].copy()
 
+                self._record_boolean('unite', entities[:1], entities[1:])
+                mirror_bbox = union_bbox([entity.mirror_bbox
+                                          for entity in entities])
                 union_entity = self.interface.unite(entities, keep_originals=keep_originals)
+                union_entity.mirror_bbox = mirror_bbox
+                union_entity.body.invalidate_bbox(union_entity)
                 union_entity.is_boolean = True
                 list_fillet = [entity.is_fillet for entity in entities]
                 union_entity.is_fillet = union_entity.is_fillet or any(list_fillet)
@@ -155,16 +415,20 @@ class Modeler():
 
         return union_entity
 
+    @journaled('modeler')
     def subtract(self, blank_entities, tool_entities, keep_originals=False):
         """
         tool_entities: a list of Entity or a Entity
         keep_originals: Boolean, True : the tool entities still exist after
                         boolean operation
         """
-        if not isinstance(blank_entities, list):
+        if isinstance(blank_entities, Entity):
             blank_entities = [blank_entities]
-        if not isinstance(tool_entities, list):
+        blank_entities = list(blank_entities)
+        if isinstance(tool_entities, Entity):
             tool_entities = [tool_entities]
+        tool_entities = list(tool_entities)
+        self.apply_moves(blank_entities+tool_entities)
         if len(blank_entities)==0 or len(tool_entities)==0:
             pass
         else:
@@ -175,12 +439,15 @@ class Modeler():
                 raise TypeError('All subtracted elements should have the \
                                 same dimension')
             else:
+                self._record_boolean('subtract', blank_entities,
+                                     tool_entities)
                 self.interface.subtract(blank_entities, tool_entities,
                                             keep_originals=True)
                 # actualize the properties of the blank_entities
                 list_fillet_bool = any([entity.is_fillet
                                         for entity in tool_entities])
                 for entity in blank_entities:
+                    entity.body.invalidate_bbox(entity)
                     entity.is_boolean = True
                     entity.is_fillet = entity.is_fillet or list_fillet_bool
                     # this is not optimal fillet wise but hard to do better
@@ -189,7 +456,26 @@ class Modeler():
                 for tool_entity in tools:
                     tool_entity.delete()
 
+    def _record_boolean(self, kind, blank_entities, tool_entities):
+        # the tools are usually deleted, their current history is kept
+        tools = []
+        dependencies = set()
+        for tool_entity in tool_entities:
+            dependencies |= tool_entity.dependencies or set()
+            if tool_entity.history is None:
+                for blank_entity in blank_entities:
+                    blank_entity.freeze()
+            else:
+                tools.append((tool_entity.layer, list(tool_entity.history)))
+        for blank_entity in blank_entities:
+            blank_entity.record(kind, tools, dependencies=dependencies)
+
+    @journaled('modeler')
     def rotate(self, entities, angle=0):
+        if isinstance(entities, Entity):
+            entities = [entities]
+        entities = list(entities)
+        self.apply_moves(entities)
         if isinstance(angle, (list, np.ndarray)):
             if len(angle)==2:
                 angle = np.math.atan2(np.linalg.det([[1,0],angle]),np.dot([1,0],angle))
@@ -199,11 +485,29 @@ class Modeler():
         elif not isinstance(angle, (float, int)):
             raise Exception("angle should be either a float or a 2-dim array")
         if self.mode == 'gds':
+            for entity in entities:
+                entity.record('rotate', angle)
             angle = val(angle)
+        for entity in entities:
+            if entity.mirror_bbox is not None:
+                entity.mirror_bbox = rotate_bbox(entity.mirror_bbox, val(angle))
+            entity.body.invalidate_bbox(entity)
         self.interface.rotate(entities, angle)  # angle in degrees
 
+    @journaled('modeler')
     def translate(self, entities, vector=[0, 0, 0]):
+        if isinstance(entities, Entity):
+            entities = [entities]
+        entities = list(entities)
+        self.apply_moves(entities)
         vector = parse_entry(vector)
         if self.mode == 'gds':
+            for entity in entities:
+                entity.record('translate', vector)
             vector = val(vector)
+        for entity in entities:
+            if entity.mirror_bbox is not None:
+                entity.mirror_bbox = translate_bbox(entity.mirror_bbox,
+                                                    val(vector))
+            entity.body.invalidate_bbox(entity)
         self.interface.translate(entities, vector)
@@ -2,18 +2,25 @@ import numpy as np
 import math
 
 from ..utils import Vector, \
+                   VectorArray, \
                    parse_entry, \
                    check_name, \
-                   find_last_list, \
+                   NameRegistry, \
                    val
 
 class Port():
-    dict_instances  = {}
+    dict_instances  = NameRegistry()
+    __slots__ = ('name', 'pending_move', '_pos', '_ori', 'constraint_port',
+                 'save', 'body', 'widths', 'subnames', 'layers', 'offsets',
+                 'N', '_r')
 
     def __init__(self, body, name, pos, ori, widths, subnames, layers, offsets, constraint_port, key='name'):
         if not (isinstance(key, Port) or key is None):
             name = check_name(self.__class__, name)
         self.name = name
+        # (angle, vector) of the enclosing 'with body(pos, ori)' scopes that
+        # is not applied yet, see Port.apply_moves
+        self.pending_move = None
         self.pos = Vector(pos)
         self.ori = Vector(ori)
         self.constraint_port = constraint_port
@@ -32,38 +39,82 @@ class Port():
             self.offsets = offsets
             self.N = 0
 
-        if self.body.ports_to_move is not None:
-            find_last_list(self.body.ports_to_move).append(self)
+        # the reversed version of the port, called by either port.r or
+        # 'port_name_r', is only created when needed
+        self._r = None
         if key=='name':  # normal initialisation
+            self.body.ports_to_move.add(self)
             self.dict_instances[name] = self
-
-            # create a reversed version of the port that can be called by either
-            # port.r or 'port_name.r'
-            reversed_ori = -self.ori
-            reversed_offsets = None
-            if self.offsets is not None:
-                reversed_offsets = []
-                for ii in range(self.N):
-                    reversed_offsets.append(-self.offsets[ii])
-            self.r = Port(self.body, self.name+'_r', self.pos, reversed_ori,
-                          self.widths, self.subnames, self.layers,
-                          reversed_offsets, self.constraint_port, key=self)
+            self.dict_instances.reserve(name+'_r')
 
         elif isinstance(key, Port):  # reverse initialisation, key is the previous port
-            self.dict_instances[name] = self
-            self.r = key
+            # the reversed port is moved with the previous port
+            self.body.ports_to_move.add_next_to(key, self)
+            if self.dict_instances.get(key.name) is key:
+                self.dict_instances.unreserve(name)
+                self.dict_instances[name] = self
+            self._r = key
         else:
+            self.body.ports_to_move.add(self)
             pass  # when the port is only a float eval do not add it in dict
 
     def __str__(self):
         return self.name
 
+    # the pending move is applied as soon as the position or orientation of
+    # the port is used
+    @property
+    def pos(self):
+        if self.pending_move is not None:
+            Port.apply_moves([self])
+        return self._pos
+
+    @pos.setter
+    def pos(self, pos):
+        if self.pending_move is not None:
+            Port.apply_moves([self])
+        self._pos = pos
+
+    @property
+    def ori(self):
+        if self.pending_move is not None:
+            Port.apply_moves([self])
+        return self._ori
+
+    @ori.setter
+    def ori(self, ori):
+        if self.pending_move is not None:
+            Port.apply_moves([self])
+        self._ori = ori
+
+    @property
+    def r(self):
+        if self._r is None:
+            reversed_offsets = None
+            if self.offsets is not None:
+                reversed_offsets = []
+                for ii in range(self.N):
+                    reversed_offsets.append(-self.offsets[ii])
+            self._r = Port(self.body, self.name+'_r', self.pos, -self.ori,
+                           self.widths, self.subnames, self.layers,
+                           reversed_offsets, self.constraint_port, key=self)
+        return self._r
+
+    @staticmethod
+    def find(name):
+        # port called name, reversed ports are created on demand
+        if name in Port.dict_instances:
+            return Port.dict_instances[name]
+        if name.endswith('_r') and name[:-2] in Port.dict_instances:
+            return Port.dict_instances[name[:-2]].r
+        return None
+
     def __repr__(self):
         return self.name
 
     @staticmethod
     def reset():
-        Port.dict_instances  = {}
+        Port.dict_instances  = NameRegistry()
 
     @classmethod
     def print_instances(cls):
@@ -119,15 +170,8 @@ class Port():
             _widths.append(val(width))
             _offsets.append(val(offset))
 
-        _pos = []
-        for coor in self.pos:
-            _pos.append(val(coor))
-        _pos = Vector(_pos)
-
-        _ori = []
-        for coor in self.ori:
-            _ori.append(val(coor))
-        _ori = Vector(_ori)
+        _pos = val(Vector(self.pos))
+        _ori = val(Vector(self.ori))
 
         return Port(self.body, self.name, _pos, _ori, _widths, self.subnames,
                     self.layers, _offsets, self.constraint_port, key=None)
@@ -162,6 +206,18 @@ class Port():
                 y_min_val = _y_min_val
         return y_max, y_min
 
+    @staticmethod
+    def apply_moves(ports):
+        # one rotation and translation per distinct pending move
+        moves = {}
+        for port in ports:
+            if port.pending_move is not None:
+                moves.setdefault(port.pending_move, []).append(port)
+                port.pending_move = None
+        for (angle, vector), moved in moves.items():
+            Port.rotate_ports(moved, angle)
+            Port.translate_ports(moved, list(vector))
+
     @staticmethod
     def translate_ports(ports, vector):
         for port in ports:
@@ -179,8 +235,20 @@ class Port():
             new_angle=angle
         rad = new_angle/180*np.pi
         rotate_matrix = np.array([[np.cos(rad) ,np.sin(-rad)],[np.sin(rad) ,np.cos(rad)]])
+        ports = list(ports)
         for port in ports:
             port.ori = rotate_matrix.dot(port.ori[0:2])
-            posx = port.pos[0]*math.cos(rad)+port.pos[1]*math.sin(-rad)
-            posy = port.pos[0]*math.sin(rad)+port.pos[1]*math.cos(rad)
-            port.pos = Vector([posx, posy])
+
+        # numeric positions are rotated all at once
+        numeric_ports = [port for port in ports if port.pos.is_numeric()]
+        if numeric_ports:
+            positions = VectorArray([port.pos[0:2] for port in numeric_ports])
+            positions = positions.rotate(new_angle)
+            for port, pos in zip(numeric_ports, positions):
+                port.pos = pos
+
+        for port in ports:
+            if not port.pos.is_numeric():
+                posx = port.pos[0]*math.cos(rad)+port.pos[1]*math.sin(-rad)
+                posy = port.pos[0]*math.sin(rad)+port.pos[1]*math.cos(rad)
+                port.pos = Vector([posx, posy])
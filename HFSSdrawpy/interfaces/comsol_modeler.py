@@ -515,7 +515,8 @@ class ComsolModeler():
 
         return path_name
 
-    def copy(self, entity):
+    def copy(self, entity, name=None):
+        # the copy is named after its transform
         name = entity.name
         #wp = self._find_workplane(name)
 
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Part of the gds interfaces that does not depend on the library drawing the
+polygons, shared by GdsModeler (gdspy) and GdstkModeler (gdstk): replay of
+the entity histories, cached export, fracture report and the operations
+that have no meaning in gds.
+"""
+
+import numpy as np
+from types import SimpleNamespace
+
+from ..utils import parse_entry, val, VectorArray
+
+def _strip_cuts(points, max_points, strip):
+    # axis and positions of every strip-th cut of the fracture of a polygon
+    # (typically a ground plane), None if it is cut less than strip times
+    ncuts = len(points) // max_points
+    if ncuts <= strip:
+        return None
+    span = points.max(axis=0) - points.min(axis=0)
+    axis = 0 if span[0] > span[1] else 1
+    coordinates = np.sort(points[:, axis])
+    cuts = [float(coordinates[int(ii*len(coordinates)/(ncuts + 1.0) + 0.5)])
+            for ii in range(strip, ncuts + 1, strip)]
+    return axis, cuts
+
+class _Replayed():
+    """Stands for an entity while its polygons are rebuilt from its history"""
+
+    def __init__(self, modeler, name, layer, body):
+        self.modeler = modeler
+        self.name = name
+        self.layer = layer
+        self.body = body
+
+    def delete(self):
+        self.modeler.delete(self)
+
+class GdsBase():
+    """
+    Base class of the gds interfaces
+
+    The subclasses keep the objects of the entities in gds_object_instances
+    and those of the bodies in gds_cells, and define the drawing primitives
+    and the following:
+        cache_tag: (library, version) part of the cache keys
+        _export_cell(cell_name): cell of a body and the cells it references
+        _add_empty(name, layer): draws an empty entity in the current cell
+        _fracture(cells, max_points, strips)
+    """
+    dict_units = {'km':1.0e3,'m':1.0,'cm':1.0e-2,'mm':1.0e-3}
+
+    def reset_cell(self):
+        del self.cell
+
+    def set_coor_sys(self, coor_sys):
+        if coor_sys in self.gds_cells.keys():
+            self.cell = self.gds_cells[coor_sys]
+        else:
+            raise ValueError('%s cell do not exist'%coor_sys)
+
+    def set_units(self, units='m'):
+        self.unit = self.dict_units[units]
+
+    def _export(self, file, max_points, cache, inputs, report, strips):
+        """
+        Fractures the cells to be written by generate_gds and returns
+        [(cell, referenced cells, filename, cache key)] and
+        {id(cell): cell} of all of them. The files of the cells found in
+        cache are copied from it instead.
+        """
+        to_write = []
+        for cell_name in list(self.gds_cells):
+            filename = file+'_%s.gds'%cell_name if len(self.gds_cells.keys())>1 else f"{file}.gds"
+            key = None
+            if cache is not None and cell_name in inputs:
+                key = cache.key(*self.cache_tag, max_points, strips,
+                                self.instancing, cell_name, inputs[cell_name])
+                data = cache.get(key)
+                if data is not None:
+                    with open(filename, 'wb') as f:
+                        f.write(data)
+                    continue
+            # the referenced cells are written in the file of each cell
+            # referencing them
+            to_write.append((*self._export_cell(cell_name), filename, key))
+
+        cells = {}
+        for cell, base_cells, filename, key in to_write:
+            for current_cell in [cell]+base_cells:
+                cells[id(current_cell)] = current_cell
+        self._fracture(list(cells.values()), max_points, strips)
+        if report:
+            self.print_fracture_report()
+        return to_write, cells
+
+    def _store(self, cache, to_write):
+        # puts the written files in cache
+        for cell, base_cells, filename, key in to_write:
+            if key is not None:
+                with open(filename, 'rb') as f:
+                    cache.put(key, f.read())
+
+    def close_stream(self):
+        self._stream.close()
+        self._stream = None
+
+    def print_fracture_report(self):
+        print('layer  polygons  vertices  fracture time (s)')
+        for layer, layer_report in self.fracture_report.items():
+            print('%5d  %8d  %8d  %.3f'%(layer, layer_report['polygons'],
+                                         layer_report['vertices'],
+                                         layer_report['time']))
+
+    def rebuild(self, entity):
+        """
+        Redraws the polygons of entity by replaying its history with the
+        current values of the variables
+        """
+        if entity.name not in self.gds_object_instances:
+            return
+        # the pending booleans are replayed from the history too
+        self.delete(entity)
+        self._replay(entity.name, entity.layer, entity.body, entity.history)
+
+    def _replay(self, name, layer, body, history):
+        self.cell = self.gds_cells[body.name]
+        replayed = _Replayed(self, name, layer, body)
+        for operation in history:
+            kind = operation[0]
+            if kind == 'draw':
+                method, geometry, options = operation[1:]
+                getattr(self, method)(*val(*geometry, marker=False), *options,
+                                      name=name, layer=layer)
+            elif kind == 'path':
+                self._replay_path(name, body, *operation[1:])
+            elif kind == 'rotate':
+                self.rotate(replayed, val(operation[1]))
+            elif kind == 'translate':
+                self.translate(replayed, val(operation[1]))
+            elif kind == 'fillet':
+                radius, vertex_indices = operation[1:]
+                self.fillet(replayed, val(radius), vertex_indices)
+            elif kind in ('unite', 'subtract'):
+                tools = []
+                for ii, (tool_layer, tool_history) in enumerate(operation[1]):
+                    tools.append(self._replay('%s#%d'%(name, ii), tool_layer,
+                                              body, tool_history))
+                self.cell = self.gds_cells[body.name]
+                if kind == 'unite':
+                    self.unite([replayed]+tools)
+                else:
+                    self.subtract(replayed, tools)
+                for tool in tools:
+                    self.delete(tool)
+            if name not in self.gds_object_instances:
+                # fully subtracted
+                self._add_empty(name, layer)
+                break
+        return replayed
+
+    def _replay_path(self, name, body, points, widths, offsets, layers,
+                     subnames, fillet, corner, index):
+        port = SimpleNamespace(widths=val(widths), offsets=val(offsets),
+                               layers=layers, subnames=subnames)
+        points_2D = VectorArray(val(points))[:, :2]
+        names, _ = self.path(points_2D, port, val(fillet), name=name+'#',
+                             corner=corner)
+        for ii, current_name in enumerate(names):
+            part = _Replayed(self, current_name, None, body)
+            if ii == index:
+                self.rename(part, name)
+            else:
+                self.delete(part)
+
+    def box(self, pos, size, **kwargs):
+        pass
+
+    def box_center(self, pos, size, **kwargs):
+        pass
+
+    def rect_center(self, pos, size, **kwargs):
+        pos, size = parse_entry(pos, size)
+        corner_pos = [val(p) - val(s)/2 for p, s in zip(pos, size)]
+        self.rect(corner_pos, size, **kwargs)
+
+    def cylinder(self, pos, radius, height, axis, **kwargs):
+        pass
+
+    def wirebond(self, pos, ori, ymax, ymin, height='0.1mm', **kwargs): #ori should be normed
+        bond_diam = '20um'
+        pos, ori, ymax, ymin, heigth, bond_diam = parse_entry((pos, ori, ymax, ymin, height, bond_diam))
+        bond1 = pos + ori.orth()*(ymax+2*bond_diam)
+        bond2 = pos + ori.orth()*(ymin-2*bond_diam)
+        self.disk(bond1, bond_diam/2, 'Z', layer=kwargs['layer'], name=kwargs['name']+'a', number_of_points=6)
+        self.disk(bond2, bond_diam/2, 'Z', layer=kwargs['layer'], name=kwargs['name']+'b', number_of_points=6)
+
+    def connect_faces(self, entity1, entity2):
+        pass
+
+    def rename_entity(self, entity, name):
+        self.rename(entity, name)
+
+    def intersect(self, entities):
+        raise NotImplementedError()
+
+    def assign_material(self, *args, **kwargs):
+        pass
+
+    def assign_perfect_E(self, entity, name=None):
+        pass
+
+    def assign_impedance(self, entities, ResistanceSq, ReactanceSq, name="impedance"):
+        pass
+
+    def assign_perfect_E_faces(self, entity):
+        pass
+
+    def assign_mesh_length(self, entity, length):#, suff = '_mesh'):
+        pass
+
+    def assign_lumped_rlc(self, entity, r, l, c, start, end, name="RLC"):
+        pass
+
+    def assign_waveport(self, *args, **kwargs):
+        pass
+
+    def assign_terminal_auto(self, *args, **kwargs):
+        pass
+
+    def create_object_from_face(self, name):
+        pass
+
+    def get_vertex_ids(self, entity):
+        return None
+
+    def mirrorZ(self, entity):
+        pass
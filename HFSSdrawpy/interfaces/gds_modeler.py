@@ -5,86 +5,579 @@ Created on Mon Nov  4 11:13:09 2019
 @author: antho
 """
 
+import datetime
+import hashlib
+import io
+import time
+import weakref
 import numpy as np
 import gdspy
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
 
-from ..utils import parse_entry, val, Vector
+from ..utils import parse_entry, val, Vector, VectorArray, variables, \
+    store_variable, store_variables, preset_values
 from ..core.entity import gen_name
+from .gds_base import GdsBase, _strip_cuts
 
 TOLERANCE = 1e-8 # for arcs
-print("gdspy_version : ",gdspy.__version__)
 
-class GdsModeler():
+def _points(obj):
+    # vertices arrays of the polygons of a gdspy object
+    if isinstance(obj, gdspy.FlexPath):
+        return obj.get_polygons()
+    return list(obj.polygons)
+
+def _bboxes(polygons):
+    # array of shape (N, 2, 2) of the bounding boxes of the polygons
+    if len(polygons) == 0:
+        return np.zeros((0, 2, 2))
+    return np.array([[points.min(axis=0), points.max(axis=0)]
+                     for points in polygons])
+
+def _overlapping(bboxes, other_bboxes):
+    # indices of bboxes overlapping the union of other_bboxes
+    if len(bboxes) == 0 or len(other_bboxes) == 0:
+        return []
+    low, high = other_bboxes[:, 0].min(axis=0), other_bboxes[:, 1].max(axis=0)
+    mask = np.all((bboxes[:, 0] <= high) & (bboxes[:, 1] >= low), axis=1)
+    return np.flatnonzero(mask)
+
+def _fused_boolean(polygons, operations, layer):
+    # applies the pending operations [(operation, tool polygons), ...] to
+    # polygons, module level to be run by the processes of GdsModeler._pool
+    result = None
+    for operation, tools in operations:
+        if operation == 'not':
+            # only the tools overlapping the blank matter
+            tools = [tools[ii] for ii in _overlapping(_bboxes(tools),
+                                                      _bboxes(polygons))]
+        if len(polygons) == 0 and (operation == 'not' or len(tools) == 0):
+            result = None
+        else:
+            result = gdspy.boolean(polygons, tools, operation,
+                                   precision=TOLERANCE, max_points=0,
+                                   layer=layer)
+        polygons = [] if result is None else result.polygons
+    return result
+
+def _binary_cells(cells, timestamp):
+    # gds records of the cells, module level to be run by the processes of
+    # GdsModeler._pool
+    stream = io.BytesIO()
+    for cell in cells:
+        cell.to_gds(stream, 1e9, timestamp)
+    return stream.getvalue()
+
+def _write_cells(filename, cells, timestamp):
+    # library of the cells, in units of meters with a precision of 1nm
+    writer = gdspy.GdsWriter(filename, unit=1.0, precision=1e-9,
+                             timestamp=timestamp)
+    for cell in cells:
+        writer.write_cell(cell, timestamp)
+    writer.close()
+    return filename
+
+# number of vertices of the chunks of polygons fractured by each process
+FRACTURE_CHUNK = 100000
+
+# with strips, polygons with more than FRACTURE_STRIP*max_points vertices
+# are cut in strips before being fractured
+FRACTURE_STRIP = 25
+
+def _strips(points, max_points):
+    # the strips between every FRACTURE_STRIP cut of PolygonSet.fracture
+    strip_cuts = _strip_cuts(points, max_points, FRACTURE_STRIP)
+    if strip_cuts is None:
+        return [points]
+    axis, cuts = strip_cuts
+    sliced = gdspy.slice([points], cuts, axis, precision=1e-9)
+    return [strip for polygon_set in sliced if polygon_set is not None
+            for strip in polygon_set.polygons]
+
+def _fracture(polygons, max_points):
+    # pieces of each of polygons and the time it took, module level to be
+    # run by the processes of GdsModeler._pool
+    start = time.perf_counter()
+    polygon_set = gdspy.PolygonSet(polygons)
+    # the layers are used to recover the polygon each piece comes from
+    polygon_set.layers = list(range(len(polygons)))
+    polygon_set.fracture(max_points=max_points, precision=1e-9)
+    pieces = [[] for _ in polygons]
+    for index, points in zip(polygon_set.layers, polygon_set.polygons):
+        pieces[index].append(points)
+    return pieces, time.perf_counter() - start
+
+# objects placing the polygons of another cell, see GdsModeler._polygons
+REFERENCES = (gdspy.CellReference, gdspy.CellArray)
+
+def _copy_reference(reference):
+    # gdspy.copy would copy the referenced cell as well
+    if isinstance(reference, gdspy.CellArray):
+        return gdspy.CellArray(reference.ref_cell, reference.columns,
+                               reference.rows, reference.spacing,
+                               reference.origin, reference.rotation)
+    return gdspy.CellReference(reference.ref_cell, reference.origin,
+                               reference.rotation)
+
+# geometry shared by the processes of GdsModeler.sweep, see _init_sweep
+_sweep = {}
+
+def _init_sweep(cells, replayed, exprs, current_variables):
+    variables.update(current_variables)
+    _sweep['cells'] = cells
+    _sweep['replayed'] = replayed
+    _sweep['exprs'] = exprs
+
+def _write_variant(file, max_points, assignment, values):
+    for symbol, value in assignment.items():
+        store_variable(symbol, value)
+    preset_values(zip(_sweep['exprs'], values))
+
+    modeler = GdsModeler()
+    # the class dicts hold the geometry of the main design
+    modeler.gds_object_instances = {}
+    modeler.gds_cells = {}
+    for cell_name, polygons in _sweep['cells']:
+        modeler.create_coor_sys(cell_name)
+        for polygon in polygons:
+            if isinstance(polygon, REFERENCES):
+                # the referenced cells are shared, only their polygons are
+                # fractured
+                modeler.cell.add(_copy_reference(polygon))
+            else:
+                modeler.cell.add(gdspy.copy(polygon))
+    for cell_name, name, layer, history in _sweep['replayed']:
+        modeler._replay(name, layer, SimpleNamespace(name=cell_name), history)
+    modeler.generate_gds(file, max_points)
+    return file
+
+class GdsModeler(GdsBase):
     """Class for generating GDS models"""
     gds_object_instances = {}
     gds_cells  = {}
-    dict_units = {'km':1.0e3,'m':1.0,'cm':1.0e-2,'mm':1.0e-3}
+    cache_tag = ('gds', gdspy.__version__)
     # coor_systems = {'Global':[[0,0,0],[1,0]]}
     # coor_system = coor_systems['Global']
 
-    def __init__(self, unit=1.0e-6, precision=1.0e-9):
+    def __init__(self, unit=1.0e-6, precision=1.0e-9, instancing=False,
+                 processes=1):
         self.unit = unit
         self.precision = precision
-        gdspy.current_library = gdspy.GdsLibrary()
+        # if True, copies are references to a cell holding the geometry
+        # once, they are flattened when their polygons are needed
+        self.instancing = instancing
+        # booleans are evaluated when the geometry is needed, the successive
+        # operations of the same kind are fused in a single one
+        # {name: (entity, [(operation, tool polygons), ...], moves of the
+        #         result)}
+        self._pending = {}
+        # number of processes evaluating the booleans of independent blanks,
+        # the pool is created when first needed
+        self.processes = processes
+        self._executor = None
+        # {(kind, layer, geometry): cell} of the arrays
+        self._base_cells = {}
+        # the cells are written from this library, even if another
+        # GdsModeler replaces the current gdspy library
+        self.library = gdspy.current_library = gdspy.GdsLibrary()
+        # polygons waiting to be removed from their cell
+        # {id(cell): (cell, {id(polygon): polygon})}
+        self._removed = {}
 
     @classmethod
     def print_instances(cls):
         for instance_name in cls.gds_object_instances:
             print(instance_name)
 
-    def reset_cell(self):
-        del self.cell
-
     def create_coor_sys(self, coor_sys='chip', rel_coor=None,
                         ref_name='Global'):
         # this creates a cell, should not care about the rel_coor
-        if not (coor_sys in gdspy.current_library.cells.keys()):
-            cell = gdspy.Cell(coor_sys)
+        if not (coor_sys in self.library.cells.keys()):
+            cell = gdspy.Cell(coor_sys, exclude_from_current=True)
+            self.library.add(cell)
             self.gds_cells[coor_sys] = cell
         else:
             cell = self.gds_cells[coor_sys]
         # active cell should be the new cell
         self.cell = cell
 
-    def set_coor_sys(self, coor_sys):
-        if coor_sys in self.gds_cells.keys():
-            self.cell = self.gds_cells[coor_sys]
+    def copy(self, entity, name):
+        self._evaluate(entity.name)
+        new_name = name
+        obj = self.gds_object_instances[entity.name]
+        if isinstance(obj, REFERENCES):
+            new_polygon = _copy_reference(obj)
+        elif self.instancing:
+            new_polygon = _copy_reference(self._instance(entity))
         else:
-            raise ValueError('%s cell do not exist'%coor_sys)
-
-    def copy(self, entity, name=None):
-        new_polygon = gdspy.copy(self.gds_object_instances[entity.name], 0, 0)
-        new_name = name if name is not None else gen_name(entity.name)
+            new_polygon = gdspy.copy(obj, 0, 0)
         self.gds_object_instances[new_name] = new_polygon
         self.cell.add(new_polygon)
 
+    def _new_cell(self, name):
+        # cell referenced by the cells of the bodies, written along them
+        while name in self.library.cells:
+            name = gen_name(name)
+        cell = gdspy.Cell(name, exclude_from_current=True)
+        self.library.add(cell)
+        return cell
+
+    def _instance(self, entity):
+        # reference replacing the polygon of entity, which is moved to its
+        # own cell to be referenced by the copies
+        obj = self.gds_object_instances[entity.name]
+        if isinstance(obj, REFERENCES):
+            return obj
+        cell = self.gds_cells[entity.body.name]
+        base_cell = self._new_cell('%s_%s'%(entity.body.name, entity.name))
+        self._remove_from_cell(cell, obj)
+        base_cell.add(obj)
+        reference = gdspy.CellReference(base_cell, (0, 0), 0)
+        self.gds_object_instances[entity.name] = reference
+        cell.add(reference)
+        return reference
+
+    def _base_cell(self, key, create):
+        # cell holding the polygons create() shared by all the arrays of
+        # the same key
+        if key not in self._base_cells:
+            base_cell = self._new_cell('%s_base'%key[0])
+            base_cell.add(create())
+            self._base_cells[key] = base_cell
+        return self._base_cells[key]
+
+    def _polygons(self, obj):
+        # polygons of a reference or an array as a PolygonSet, other objects
+        # as is
+        if not isinstance(obj, REFERENCES):
+            return obj
+        polygons, layers, datatypes = [], [], []
+        for (layer, datatype), points in \
+                obj.get_polygons(by_spec=True).items():
+            polygons += points
+            layers += [layer]*len(points)
+            datatypes += [datatype]*len(points)
+        polygon_set = gdspy.PolygonSet(polygons)
+        polygon_set.layers = layers
+        polygon_set.datatypes = datatypes
+        return polygon_set
+
+    def _flatten(self, entity):
+        # replaces the reference of entity by its polygons in its cell
+        self._evaluate(entity.name)
+        obj = self.gds_object_instances[entity.name]
+        if not isinstance(obj, REFERENCES):
+            return obj
+        cell = self.gds_cells[entity.body.name]
+        self._remove_from_cell(cell, obj)
+        polygon_set = self._polygons(obj)
+        self.gds_object_instances[entity.name] = polygon_set
+        cell.add(polygon_set)
+        return polygon_set
+
     def rename(self, entity, name):
         obj = self.gds_object_instances.pop(entity.name)
         self.gds_object_instances[name]=obj
-
-    def generate_gds(self, file, max_points):
-        for instance in self.gds_object_instances.keys():
-            obj = self.gds_object_instances[instance]
-            if isinstance(obj, gdspy.Polygon) or isinstance(obj, gdspy.PolygonSet):
-                self.gds_object_instances[instance] = obj.fracture(max_points=max_points, precision=1e-9)
-        for cell_name in self.gds_cells.keys():
-            filename = file+'_%s.gds'%cell_name if len(self.gds_cells.keys())>1 else f"{file}.gds"
-            gdspy.write_gds(filename, cells=[cell_name],
-                            unit=1.0, precision=1e-9)
+        if entity.name in self._pending:
+            self._pending[name] = self._pending.pop(entity.name)
+
+    def _remove_from_cell(self, cell, polygon):
+        # removing from cell.polygons is O(n), the removals are applied in a
+        # single pass by _apply_removals before the cells are read
+        self._removed.setdefault(id(cell), (cell, {}))[1][id(polygon)] = polygon
+
+    def _apply_removals(self):
+        for cell, removed in self._removed.values():
+            cell.polygons = [polygon for polygon in cell.polygons
+                             if id(polygon) not in removed]
+            cell.paths = [path for path in cell.paths
+                          if id(path) not in removed]
+            cell.references = [reference for reference in cell.references
+                               if id(reference) not in removed]
+            cell._bb_valid = False
+        self._removed = {}
+
+    def generate_gds(self, file, max_points, cache=None, inputs=None,
+                     report=False, single_file=False, strips=False):
+        """
+        Writes one gds file per cell. If a BuildCache is given, the cells
+        whose inputs ({cell name: json compatible inputs}) were already built
+        are copied from the cache instead of being fractured and written.
+        If report, prints the fracture time and the number of polygons and
+        vertices written per layer, also kept in self.fracture_report.
+        If single_file, all the cells are written in file.gds, the cache is
+        not used. See _fracture for strips.
+        The cells are serialized by the process pool if processes is not 1.
+        """
+        self._evaluate(*list(self._pending))
+        self._apply_removals()
+        if single_file:
+            cache = None
+        to_write, cells = self._export(file, max_points, cache, inputs,
+                                       report, strips)
+
+        # the same timestamp for all the files, whichever process writes them
+        timestamp = datetime.datetime.today()
+        parallel = self.processes != 1
+        if single_file:
+            # cells serialized separately, gathered in a single library
+            chunks = [[cell] for cell in cells.values()]
+            if parallel and len(chunks) > 1:
+                binary_cells = self._pool().map(_binary_cells, chunks,
+                                                [timestamp]*len(chunks))
+            else:
+                binary_cells = map(_binary_cells, chunks,
+                                   [timestamp]*len(chunks))
+            writer = gdspy.GdsWriter(f"{file}.gds", unit=1.0, precision=1e-9,
+                                     timestamp=timestamp)
+            writer.write_binary_cells(binary_cells)
+            writer.close()
+            return
+
+        jobs = [(filename, [cell]+base_cells, timestamp)
+                for cell, base_cells, filename, key in to_write]
+        if parallel and len(jobs) > 1:
+            written = self._pool().map(_write_cells, *zip(*jobs))
+        else:
+            written = [_write_cells(*job) for job in jobs]
+        # waits for the files to be written
+        list(written)
+        self._store(cache, to_write)
+
+    def _export_cell(self, cell_name):
+        cell = self.gds_cells[cell_name]
+        return cell, list(cell.get_dependencies(True))
+
+    def _add_empty(self, name, layer):
+        empty = gdspy.PolygonSet([], layer=layer)
+        self.gds_object_instances[name] = empty
+        self.cell.add(empty)
+
+    def open_stream(self, file, max_points, strips=False):
+        # the cells are then written one by one by write_cell
+        self._stream = gdspy.GdsWriter(file+'.gds', unit=1.0, precision=1e-9)
+        self._stream_max_points = max_points
+        self._stream_strips = strips
+        # names of the cells already written, the ids of the cells released
+        # by write_cell are reused by new cells
+        self._streamed = set()
+
+    def write_cell(self, cell_name):
+        """
+        Writes the cell to the file opened by open_stream, with the cells it
+        references that were not written yet, and releases its polygons.
+        """
+        self._evaluate(*[name for name, (entity, _, _) in self._pending.items()
+                         if entity.body.name == cell_name])
+        self._apply_removals()
+        cell, base_cells = self._export_cell(cell_name)
+        cells = [current_cell for current_cell in [cell]+base_cells
+                 if current_cell.name not in self._streamed]
+        self._fracture(cells, self._stream_max_points, self._stream_strips)
+        for current_cell in cells:
+            self._stream.write_cell(current_cell)
+            self._streamed.add(current_cell.name)
+
+        # the referenced cells are kept, other cells may reference them
+        owned = {id(obj) for obj in cell.polygons+cell.paths+cell.references}
+        for name in [name for name, obj in self.gds_object_instances.items()
+                     if id(obj) in owned]:
+            del self.gds_object_instances[name]
+        cell.polygons, cell.paths, cell.references, cell.labels = \
+            [], [], [], []
+        del self.gds_cells[cell_name]
+
+    def _fracture(self, cells, max_points, strips=False):
+        """
+        Fractures the polygons of cells with more than max_points vertices,
+        as PolygonSet.fracture does. The polygons are sent by chunks of
+        similar size to the process pool if processes is not 1, the result
+        does not depend on it.
+        If strips, the large polygons (typically ground planes) are first cut
+        in strips fractured separately, which is much faster than cutting a
+        polygon in one go. The pieces then differ from those of
+        PolygonSet.fracture (far fewer for a plane with many holes), their
+        union is the same.
+        """
+        polygon_sets = [polygon_set for cell in cells
+                        for polygon_set in cell.polygons]
+        # {layer: [time, polygons, vertices]}
+        report = {}
+        # [(layer, [(index in polygon_sets, index in polygon_set, strip)])]
+        chunks = []
+        if max_points > 4:
+            by_layer = {}
+            for ii, polygon_set in enumerate(polygon_sets):
+                for jj, points in enumerate(polygon_set.polygons):
+                    if len(points) > max_points:
+                        layer = polygon_set.layers[jj]
+                        start = time.perf_counter()
+                        if strips:
+                            pieces = _strips(points, max_points)
+                        else:
+                            pieces = [points]
+                        report.setdefault(layer, [0, 0, 0])[0] += \
+                            time.perf_counter() - start
+                        by_layer.setdefault(layer, []).extend(
+                            (ii, jj, strip) for strip in pieces)
+            for layer in sorted(by_layer):
+                chunk, size = [], 0
+                for item in by_layer[layer]:
+                    chunk.append(item)
+                    size += len(item[2])
+                    if size >= FRACTURE_CHUNK:
+                        chunks.append((layer, chunk))
+                        chunk, size = [], 0
+                if chunk:
+                    chunks.append((layer, chunk))
+
+        jobs = [[strip for ii, jj, strip in chunk] for layer, chunk in chunks]
+        if self.processes != 1 and len(jobs) > 1:
+            results = self._pool().map(_fracture, jobs,
+                                       [max_points]*len(jobs))
+        else:
+            results = map(_fracture, jobs, [max_points]*len(jobs))
+
+        # {index in polygon_sets: {index in polygon_set: pieces}}
+        fractured = {}
+        for (layer, chunk), (pieces, elapsed) in zip(chunks, results):
+            report.setdefault(layer, [0, 0, 0])[0] += elapsed
+            for (ii, jj, strip), strip_pieces in zip(chunk, pieces):
+                fractured.setdefault(ii, {}).setdefault(jj, []).extend(
+                    strip_pieces)
+        for ii, polygon_pieces in fractured.items():
+            # same order as PolygonSet.fracture: the pieces after the
+            # polygons that are kept
+            polygon_set = polygon_sets[ii]
+            polygons, layers, datatypes = [], [], []
+            for jj, points in enumerate(polygon_set.polygons):
+                if jj not in polygon_pieces:
+                    polygons.append(points)
+                    layers.append(polygon_set.layers[jj])
+                    datatypes.append(polygon_set.datatypes[jj])
+            for jj in sorted(polygon_pieces):
+                polygons += polygon_pieces[jj]
+                layers += [polygon_set.layers[jj]]*len(polygon_pieces[jj])
+                datatypes += [polygon_set.datatypes[jj]]*len(polygon_pieces[jj])
+            polygon_set.polygons = polygons
+            polygon_set.layers = layers
+            polygon_set.datatypes = datatypes
+
+        for polygon_set in polygon_sets:
+            for layer, points in zip(polygon_set.layers, polygon_set.polygons):
+                layer_report = report.setdefault(layer, [0, 0, 0])
+                layer_report[1] += 1
+                layer_report[2] += len(points)
+        self.fracture_report = {layer: dict(zip(('time', 'polygons',
+                                                 'vertices'), values))
+                                for layer, values in sorted(report.items())}
+
+    def digest(self, entity):
+        # hash of the polygons of entity, used as cache input when the
+        # entity cannot be described by its history
+        self._evaluate(entity.name)
+        obj = self.gds_object_instances.get(entity.name)
+        if obj is None:
+            return None
+        digest = hashlib.sha256()
+        if isinstance(obj, REFERENCES):
+            # the placement and the referenced polygons, an array is not
+            # flattened
+            digest.update(repr([type(obj).__name__, obj.origin, obj.rotation,
+                                getattr(obj, 'columns', None),
+                                getattr(obj, 'rows', None),
+                                getattr(obj, 'spacing', None)]).encode())
+            polygons = obj.ref_cell.get_polygons(by_spec=True)
+        elif isinstance(obj, gdspy.FlexPath):
+            polygons = obj.get_polygons(by_spec=True)
+        else:
+            polygons = {}
+            for layer, datatype, points in zip(obj.layers, obj.datatypes,
+                                               obj.polygons):
+                polygons.setdefault((layer, datatype), []).append(points)
+        for spec in sorted(polygons):
+            digest.update(repr(spec).encode())
+            for points in polygons[spec]:
+                digest.update(np.ascontiguousarray(points, dtype=float))
+        return digest.hexdigest()
+
+    def sweep(self, entities, exprs, values, assignments, files, max_points,
+              processes=None):
+        """
+        Writes files[ii] with the entities replayed for the ii-th values of
+        the assignments {symbol: array}. values are the exprs of the entity
+        histories already evaluated for each assignment.
+        The polygons that do not belong to entities are copied as is.
+        """
+        self._evaluate(*list(self._pending))
+        self._apply_removals()
+        owned = set()
+        replayed = []
+        for entity in entities:
+            if entity.name in self.gds_object_instances:
+                owned.add(id(self.gds_object_instances[entity.name]))
+                replayed.append((entity.body.name, entity.name, entity.layer,
+                                 entity.history))
+        cells = []
+        for cell_name, cell in self.gds_cells.items():
+            cells.append((cell_name, [polygon
+                                      for polygon in cell.polygons+cell.paths
+                                      +cell.references
+                                      if id(polygon) not in owned]))
+
+        jobs = []
+        for ii, file in enumerate(files):
+            assignment = {symbol: float(symbol_values[ii])
+                          for symbol, symbol_values in assignments.items()}
+            jobs.append((file, max_points, assignment, values[:, ii]))
+
+        if processes == 1:
+            # written in this process, the values of the swept variables are
+            # restored afterwards
+            saved = {symbol: variables[symbol] for symbol in assignments
+                     if symbol in variables}
+            _init_sweep(cells, replayed, exprs, {})
+            try:
+                for job in jobs:
+                    _write_variant(*job)
+            finally:
+                store_variables(saved)
+                _sweep.clear()
+            return
+
+        with ProcessPoolExecutor(processes, initializer=_init_sweep,
+                                 initargs=(cells, replayed, exprs,
+                                           dict(variables))) as executor:
+            futures = [executor.submit(_write_variant, *job) for job in jobs]
+            for future in futures:
+                future.result()
+
+    def get_bounding_box(self, entity):
+        self._evaluate(entity.name)
+        obj = self.gds_object_instances.get(entity.name)
+        if obj is None:
+            return None
+        if isinstance(obj, gdspy.FlexPath):
+            polygons = obj.get_polygons()
+            if len(polygons) == 0:
+                return None
+            points = np.concatenate(polygons)
+            return [points.min(axis=0), points.max(axis=0)]
+        if isinstance(obj, gdspy.CellArray):
+            # the extreme elements are at the corners of the array
+            corners = gdspy.CellArray(obj.ref_cell, min(obj.columns, 2),
+                                      min(obj.rows, 2),
+                                      [obj.spacing[0]*(obj.columns-1),
+                                       obj.spacing[1]*(obj.rows-1)],
+                                      obj.origin, obj.rotation)
+            return corners.get_bounding_box()
+        return obj.get_bounding_box()
 
     def get_vertices(self, entity):
-        polygon = self.gds_object_instances[entity.name]
+        polygon = self._flatten(entity)
         return polygon.polygons[0]
 
-    def set_units(self, units='m'):
-        self.unit = self.dict_units[units]
-
-    def box(self, pos, size, **kwargs):
-        pass
-
-    def box_center(self, pos, size, **kwargs):
-        pass
-
     def text(self, pos, size, text, angle, horizontal, **kwargs):
         pos, size = parse_entry(pos, size)
         name = kwargs["name"]
@@ -102,11 +595,13 @@ class GdsModeler():
         layer = kwargs['layer']
         points = parse_entry(points)
 
-        #TODO, this is a dirty fixe cause of Vector3D
-
-        points_2D = []
-        for point in points:
-            points_2D.append([point[0], point[1]])
+        if isinstance(points, VectorArray):
+            points_2D = points[:, :2]
+        else:
+            #TODO, this is a dirty fixe cause of Vector3D
+            points_2D = []
+            for point in points:
+                points_2D.append([point[0], point[1]])
 
         if closed:
             poly1 = gdspy.Polygon(points_2D, layer=layer)
@@ -127,13 +622,32 @@ class GdsModeler():
         self.gds_object_instances[name] = poly1
         self.cell.add(poly1)
 
-    def rect_center(self, pos, size, **kwargs):
-        pos, size = parse_entry(pos, size)
-        corner_pos = [val(p) - val(s)/2 for p, s in zip(pos, size)]
-        self.rect(corner_pos, size, **kwargs)
-
-    def cylinder(self, pos, radius, height, axis, **kwargs):
-        pass
+    def rects(self, pos, size, **kwargs):
+        # pos and size are numeric arrays of shape (N, 2), one name per rect
+        names = kwargs['name']
+        layer = kwargs['layer']
+        corners = np.stack([pos, pos+size*[1, 0], pos+size, pos+size*[0, 1]],
+                           axis=1)
+        polygons = []
+        for name, points in zip(names, corners):
+            poly1 = gdspy.Polygon(points, layer)
+            self.gds_object_instances[name] = poly1
+            polygons.append(poly1)
+        self.cell.add(polygons)
+
+    def polylines(self, points_list, closed, **kwargs):
+        # points_list holds numeric arrays of shape (M, 2), one name for each
+        names = kwargs['name']
+        layer = kwargs['layer']
+        polygons = []
+        for name, points_2D in zip(names, points_list):
+            if closed:
+                poly1 = gdspy.Polygon(points_2D, layer=layer)
+            else:
+                poly1 = gdspy.FlexPath(points_2D, 1e-9, layer=layer)
+            self.gds_object_instances[name] = poly1
+            polygons.append(poly1)
+        self.cell.add(polygons)
 
     def disk(self, pos, radius, axis, number_of_points=None, **kwargs):
         pos, radius = parse_entry(pos, radius)
@@ -144,21 +658,15 @@ class GdsModeler():
         self.gds_object_instances[name] = round1
         self.cell.add(round1)
 
-    def wirebond(self, pos, ori, ymax, ymin, height='0.1mm', **kwargs): #ori should be normed
-        bond_diam = '20um'
-        pos, ori, ymax, ymin, heigth, bond_diam = parse_entry((pos, ori, ymax, ymin, height, bond_diam))
-        bond1 = pos + ori.orth()*(ymax+2*bond_diam)
-        bond2 = pos + ori.orth()*(ymin-2*bond_diam)
-        self.disk(bond1, bond_diam/2, 'Z', layer=kwargs['layer'], name=kwargs['name']+'a', number_of_points=6)
-        self.disk(bond2, bond_diam/2, 'Z', layer=kwargs['layer'], name=kwargs['name']+'b', number_of_points=6)
-
     def path(self, points, port, fillet, name='', corner="circular bend"):
 
-        #TODO, this is a dirty fixe cause of Vector3D
-
-        points_2D = []
-        for point in points:
-            points_2D.append([point[0], point[1]])
+        if isinstance(points, np.ndarray):
+            points_2D = np.asarray(points)[:, :2]
+        else:
+            #TODO, this is a dirty fixe cause of Vector3D
+            points_2D = []
+            for point in points:
+                points_2D.append([point[0], point[1]])
 
         # use dummy layers to recover the right elements
         layers = [ii  for ii in range(len(port.widths))]
@@ -180,115 +688,97 @@ class GdsModeler():
             self.cell.add(poly)
         return names, layers
 
-    def connect_faces(self, entity1, entity2):
-        pass
-
     def delete(self, entity):
-        self.cell.polygons.remove(self.gds_object_instances[entity.name])
-        self.gds_object_instances.pop(entity.name)
-
-    def rename_entity(self, entity, name):
-        polygon = self.gds_object_instances.pop(entity.name)
-        self.gds_object_instances[name] = polygon
+        self._pending.pop(entity.name, None)
+        self._remove_from_cell(self.gds_cells[entity.body.name],
+                               self.gds_object_instances.pop(entity.name))
 
     def unite(self, entities, keep_originals=True):
-
         blank_entity = entities.pop(0)
-        blank_polygon = self.gds_object_instances.pop(blank_entity.name)
-        self.cell = self.gds_cells[blank_entity.body.name]
-        self.cell.polygons.remove(blank_polygon)
-
-        tool_polygons = []
-        for tool_entity in entities:
-            tool_polygon = self.gds_object_instances[tool_entity.name]
-            if isinstance(tool_polygon, gdspy.PolygonSet):
-                for polygon in tool_polygon.polygons:
-                    tool_polygons.append(polygon)
-            else:
-                tool_polygons.append(tool_polygon)
-
-        #2 unite operation
-        tool_polygon_set = gdspy.PolygonSet(tool_polygons, layer = blank_entity.layer)
-        united = gdspy.boolean(blank_polygon, tool_polygon_set, 'or',
-                               precision=TOLERANCE, max_points=0,
-                               layer=blank_entity.layer)
-
-        self.gds_object_instances[blank_entity.name] = united
-        self.cell.add(united)
-
+        self._defer(blank_entity, 'or', self._tool_polygons(entities))
         return blank_entity
 
-    def intersect(self, entities):
-        raise NotImplementedError()
-
     def subtract(self, blank_entities, tool_entities, keep_originals=True):
-        if isinstance(blank_entities, list):
-            for blank_entity in blank_entities:
-                self.subtract(blank_entity, tool_entities,
-                              keep_originals=keep_originals)
+        if not isinstance(blank_entities, list):
+            blank_entities = [blank_entities]
+        tool_polygons = self._tool_polygons(tool_entities)
+        if len(blank_entities) > 1 and tool_polygons:
+            # merged once rather than by the boolean of each blank
+            merged = gdspy.boolean(tool_polygons, None, 'or',
+                                   precision=TOLERANCE, max_points=0)
+            tool_polygons = [] if merged is None else merged.polygons
+        for blank_entity in blank_entities:
+            self._defer(blank_entity, 'not', tool_polygons)
+
+    def _tool_polygons(self, tool_entities):
+        self._evaluate(*[tool_entity.name for tool_entity in tool_entities])
+        tool_polygons = []
+        for tool_entity in tool_entities:
+            tool_polygons += _points(self._polygons(
+                self.gds_object_instances[tool_entity.name]))
+        return tool_polygons
+
+    def _defer(self, entity, operation, tool_polygons):
+        # appends the boolean to the pending ones of entity, fused with the
+        # last one if it is of the same kind
+        if entity.name in self._pending and self._pending[entity.name][2]:
+            # the entity was moved since, the tools are in the new frame
+            self._evaluate(entity.name)
+        operations = self._pending.setdefault(entity.name,
+                                              (entity, [], []))[1]
+        if operations and operations[-1][0] == operation:
+            operations[-1] = (operation, operations[-1][1]+tool_polygons)
         else:
-            blank_entity = blank_entities
-            #1 We clear the cell of all elements and create lists to store the polygons
-            blank_polygon = self.gds_object_instances.pop(blank_entity.name)
-            self.cell = self.gds_cells[blank_entity.body.name] # assumes blank and tool are in same body
-            self.cell.polygons.remove(blank_polygon)
-
-            tool_polygons = []
-            for tool_entity in tool_entities:
-                tool_polygon = self.gds_object_instances[tool_entity.name]
-                if isinstance(tool_polygon, gdspy.PolygonSet):
-                    for polygon in tool_polygon.polygons:
-                        tool_polygons.append(polygon)
+            operations.append((operation, list(tool_polygons)))
+
+    def _evaluate(self, *names):
+        # runs the pending booleans of the entities named names, in parallel
+        # if several are independent
+        names = [name for name in names if name in self._pending]
+        if not names:
+            return
+        pendings, jobs = [], []
+        for name in names:
+            entity, operations, moves = self._pending.pop(name)
+            obj = self.gds_object_instances.pop(name)
+            self._remove_from_cell(self.gds_cells[entity.body.name], obj)
+            pendings.append((entity, moves))
+            jobs.append((_points(self._polygons(obj)), operations,
+                         entity.layer))
+        if self.processes != 1 and len(jobs) > 1:
+            results = self._pool().map(_fused_boolean, *zip(*jobs))
+        else:
+            results = map(_fused_boolean, *zip(*jobs))
+        for name, (entity, moves), result in zip(names, pendings,
+                                                 list(results)):
+            if result is None:
+                print('Warning: the entity %s was fully subtracted'%name)
+                result = gdspy.PolygonSet([], layer=entity.layer)
+            for move in moves:
+                if move[0] == 'translate':
+                    result.translate(*move[1])
                 else:
-                    tool_polygons.append(tool_polygon)
-
-
-            #2 subtract operation
-            tool_polygon_set = gdspy.PolygonSet(tool_polygons, layer = blank_entity.layer)
-            subtracted = gdspy.boolean(blank_polygon, tool_polygon_set, 'not',
-                                        precision=TOLERANCE, max_points=0,
-                                        layer=blank_entity.layer)
-            if subtracted is not None:
-                #3 At last we update the cell and the gds_object_instance
-                self.gds_object_instances[blank_entity.name] = subtracted
-                self.cell.add(subtracted)
-            else:
-                print('Warning: the entity %s was fully \
-                      subtracted'%blank_entity.name)
-                dummy = gdspy.Polygon([[0, 0]])
-                self.gds_object_instances[blank_entity.name] = dummy
-                self.cell.add(dummy)
-                blank_entity.delete()
-
-    def assign_material(self, *args, **kwargs):
-        pass
-
-    def assign_perfect_E(self, entity, name=None):
-        pass
-
-    def assign_impedance(self, entities, ResistanceSq, ReactanceSq, name="impedance"):
-        pass
-
-    def assign_perfect_E_faces(self, entity):
-        pass
-
-    def assign_mesh_length(self, entity, length):#, suff = '_mesh'):
-        pass
-
-    def assign_lumped_rlc(self, entity, r, l, c, start, end, name="RLC"):
-        pass
-
-    def assign_waveport(self, *args, **kwargs):
-        pass
-
-    def assign_terminal_auto(self, *args, **kwargs):
-        pass
-
-    def create_object_from_face(self, name):
-        pass
+                    result.rotate(move[1]/360*2*np.pi, center=move[2])
+            self.gds_object_instances[name] = result
+            self.gds_cells[entity.body.name].add(result)
+
+    def _pool(self):
+        # created at the first boolean run in parallel, then reused
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.processes)
+            # the workers are stopped when the modeler is garbage collected
+            # if close was not called
+            self._shutdown = weakref.finalize(self, self._executor.shutdown)
+        return self._executor
+
+    def close(self):
+        """Stops the worker processes, they are started again if needed"""
+        if self._executor is not None:
+            self._shutdown()
+            self._executor = None
 
     def fillet(self, entity, radius, vertex_indices=None):
-        polygon = self.gds_object_instances[entity.name]
+        polygon = self._flatten(entity)
         if vertex_indices is None:
             polygon.fillet(radius, max_points=0)
         else:
@@ -299,11 +789,6 @@ class GdsModeler():
                     radii[index]=rad
             polygon.fillet([radii], max_points=0, precision=TOLERANCE)
 
-    def get_vertex_ids(self, entity):
-        return None
-
-
-
     def sweep_along_vector(self, names, vector):
         self._modeler.SweepAlongVector(self._selections_array(*names),
                                         	["NAME:VectorSweepParameters",
@@ -327,9 +812,6 @@ class GdsModeler():
                                 		"BothSides:="		, bothsides
                                 	])
 
-    def mirrorZ(self, entity):
-        pass
-
     def translate(self, entities, vector):
         '''vector is 3-dimentional but with a z=0 component'''
         if not isinstance(entities, list):
@@ -337,6 +819,11 @@ class GdsModeler():
         translation_vector = [vector[0], vector[1]]
         for entity in entities:
             # if entity!=None:
+            if entity.name in self._pending:
+                # moves the result of the pending booleans
+                self._pending[entity.name][2].append(('translate',
+                                                      translation_vector))
+                continue
             gds_entity = self.gds_object_instances[entity.name]
             gds_entity.translate(*translation_vector)
 
@@ -347,32 +834,56 @@ class GdsModeler():
 
         if not isinstance(entities, list):
             entities = [entities]
+        center = (val(center[0]), val(center[1]))
+        cos, sin = np.cos(angle/360*2*np.pi), np.sin(angle/360*2*np.pi)
         for entity in entities:
             # if entity!=None:
+            if entity.name in self._pending:
+                self._pending[entity.name][2].append(('rotate', angle,
+                                                      center))
+                continue
             gds_entity = self.gds_object_instances[entity.name]
-            gds_entity.rotate(angle/360*2*np.pi, center=(val(center[0]), val(center[1])))
+            if isinstance(gds_entity, REFERENCES):
+                # the origin of a reference turns around center
+                x = gds_entity.origin[0] - center[0]
+                y = gds_entity.origin[1] - center[1]
+                gds_entity.origin = (center[0] + cos*x - sin*y,
+                                     center[1] + sin*x + cos*y)
+                gds_entity.rotation = (gds_entity.rotation or 0) + angle
+            else:
+                gds_entity.rotate(angle/360*2*np.pi, center=center)
 
 
-    def rect_array(self, pos, size, columns,rows,spacing, origin=(0, 0), **kwargs):
-        pos, size = parse_entry(pos, size)
+    def rect_array(self, pos, size, columns, rows, spacing, **kwargs):
+        pos, size, spacing = parse_entry(pos, size, spacing)
         name = kwargs['name']
         layer = kwargs['layer']
-        points = [(pos[0],pos[1]), (pos[0]+size[0],pos[1]+0), (pos[0]+size[0],pos[1]+size[1]), (pos[0],pos[1]+size[1])]
-        poly1 = gdspy.Polygon(points, layer)
-
-        self.gds_object_instances[name] = poly1
-
-
-        cell_to_copy = gdspy.Cell('cell_to_copy')
-        self.gds_cells['cell_to_copy'] = cell_to_copy
-        cell_to_copy.add(poly1)
-
-
-        spacing = parse_entry(spacing)
-
-        cell_array=gdspy.CellArray(cell_to_copy, columns, rows, spacing, origin)
-        polygon_list=cell_array.get_polygons()
-        poly2 = gdspy.PolygonSet(polygon_list, layer)
-        self.cell.add(poly2)
-
-        self.gds_object_instances[name] = poly2
+        size = (float(size[0]), float(size[1]))
+        base_cell = self._base_cell(('rect', layer, size),
+                                    lambda: gdspy.Polygon([(0, 0), (size[0], 0),
+                                                           size, (0, size[1])],
+                                                          layer))
+        array = gdspy.CellArray(base_cell, columns, rows,
+                                (float(spacing[0]), float(spacing[1])),
+                                (float(pos[0]), float(pos[1])))
+        self.gds_object_instances[name] = array
+        self.cell.add(array)
+
+    def array(self, entity, columns, rows, spacing, **kwargs):
+        # columns x rows copies of entity, spaced along x and y
+        name = kwargs['name']
+        self._evaluate(entity.name)
+        obj = self.gds_object_instances[entity.name]
+        spacing = (float(spacing[0]), float(spacing[1]))
+        if isinstance(obj, gdspy.CellReference) and not obj.rotation:
+            base_cell, origin = obj.ref_cell, obj.origin
+        else:
+            base_cell = self._new_cell('%s_%s'%(entity.body.name, entity.name))
+            if isinstance(obj, REFERENCES):
+                base_cell.add(_copy_reference(obj))
+            else:
+                base_cell.add(gdspy.copy(obj))
+            origin = (0, 0)
+        array = gdspy.CellArray(base_cell, columns, rows, spacing, origin)
+        self.gds_object_instances[name] = array
+        self.cell.add(array)
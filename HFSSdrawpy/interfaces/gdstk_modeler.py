@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+GDS interface drawn with gdstk, a C++ rewrite of gdspy: the same methods and
+the same output as GdsModeler, with faster booleans and fracturing. Selected
+with Modeler('gdstk').
+"""
+
+import datetime
+import hashlib
+import time
+import numpy as np
+import gdspy
+import gdstk
+
+from ..utils import parse_entry, val, VectorArray
+from ..core.entity import gen_name
+from .gds_base import GdsBase, _strip_cuts
+
+TOLERANCE = 1e-8 # for arcs
+
+# with strips, polygons with more than FRACTURE_STRIP*max_points vertices
+# are sliced in strips before being fractured
+FRACTURE_STRIP = 10
+
+def _strips(polygon, max_points):
+    # Polygon.fracture cuts a large polygon (typically a ground plane) in
+    # many more pieces, and more slowly, than its strips one by one
+    strip_cuts = _strip_cuts(polygon.points, max_points, FRACTURE_STRIP)
+    if strip_cuts is None:
+        return [polygon]
+    axis, cuts = strip_cuts
+    sliced = gdstk.slice(polygon, cuts, 'xy'[axis], 1e-9)
+    return [strip for strips in sliced for strip in strips]
+
+def _rotated(vector, cos, sin):
+    return (cos*vector[0] - sin*vector[1], sin*vector[0] + cos*vector[1])
+
+class GdstkModeler(GdsBase):
+    """
+    Class for generating GDS models with gdstk
+
+    The objects of an entity are kept in a list (the gdstk booleans return
+    lists of polygons), the cells of the bodies are only built when they
+    are written.
+    """
+    cache_tag = ('gdstk', gdstk.__version__)
+
+    def __init__(self, unit=1.0e-6, precision=1.0e-9, instancing=False):
+        self.unit = unit
+        self.precision = precision
+        # if True, copies are references to a cell holding the geometry
+        # once, they are flattened when their polygons are needed
+        self.instancing = instancing
+        # {name: [gdstk objects]} of the entities
+        self.gds_object_instances = {}
+        # {cell name: {name: [gdstk objects]}} of the bodies
+        self.gds_cells = {}
+        # {name: gdstk.Cell} of the cells referenced by the bodies
+        self._referenced = {}
+        # {(kind, layer, geometry): cell} of the arrays
+        self._base_cells = {}
+
+    def print_instances(self):
+        for instance_name in self.gds_object_instances:
+            print(instance_name)
+
+    def create_coor_sys(self, coor_sys='chip', rel_coor=None,
+                        ref_name='Global'):
+        # this creates a cell, should not care about the rel_coor
+        self.cell = self.gds_cells.setdefault(coor_sys, {})
+
+    def _add(self, name, objects):
+        self.gds_object_instances[name] = objects
+        self.cell[name] = objects
+
+    def copy(self, entity, name):
+        objects = self.gds_object_instances[entity.name]
+        if self.instancing:
+            objects = self._instance(entity)
+        self._add(name, [obj.copy() for obj in objects])
+
+    def _new_cell(self, name):
+        # cell referenced by the cells of the bodies, written along them
+        while name in self._referenced or name in self.gds_cells:
+            name = gen_name(name)
+        cell = gdstk.Cell(name)
+        self._referenced[name] = cell
+        return cell
+
+    def _instance(self, entity):
+        # reference replacing the polygons of entity, which are moved to
+        # their own cell to be referenced by the copies
+        objects = self.gds_object_instances[entity.name]
+        if all(isinstance(obj, gdstk.Reference) for obj in objects):
+            return objects
+        base_cell = self._new_cell('%s_%s'%(entity.body.name, entity.name))
+        base_cell.add(*objects)
+        objects[:] = [gdstk.Reference(base_cell)]
+        return objects
+
+    def _base_cell(self, key, create):
+        # cell holding the polygons create() shared by all the arrays of
+        # the same key
+        if key not in self._base_cells:
+            base_cell = self._new_cell('%s_base'%key[0])
+            base_cell.add(*create())
+            self._base_cells[key] = base_cell
+        return self._base_cells[key]
+
+    def _polygons(self, objects):
+        # polygons of objects, the paths and references are converted
+        polygons = []
+        for obj in objects:
+            if isinstance(obj, gdstk.Polygon):
+                polygons.append(obj)
+            elif isinstance(obj, gdstk.FlexPath):
+                polygons += obj.to_polygons()
+            else:
+                polygons += obj.get_polygons()
+        return polygons
+
+    def _flatten(self, entity):
+        # replaces the references and paths of entity by their polygons
+        objects = self.gds_object_instances[entity.name]
+        objects[:] = self._polygons(objects)
+        return objects
+
+    def rename(self, entity, name):
+        objects = self.gds_object_instances.pop(entity.name)
+        self.gds_object_instances[name] = objects
+        cell = self.gds_cells[entity.body.name]
+        del cell[entity.name]
+        cell[name] = objects
+
+    def generate_gds(self, file, max_points, cache=None, inputs=None,
+                     report=False, single_file=False, strips=False):
+        """
+        Writes one gds file per cell. If a BuildCache is given, the cells
+        whose inputs ({cell name: json compatible inputs}) were already built
+        are copied from the cache instead of being fractured and written.
+        If report, prints the fracture time and the number of polygons and
+        vertices written per layer, also kept in self.fracture_report.
+        If single_file, all the cells are written in file.gds, the cache is
+        not used. If strips, the large polygons are sliced in strips before
+        being fractured, see GdsModeler._fracture.
+        """
+        if single_file:
+            cache = None
+        to_write, cells = self._export(file, max_points, cache, inputs,
+                                       report, strips)
+
+        # the same timestamp for all the files
+        timestamp = datetime.datetime.today()
+        if single_file:
+            library = gdstk.Library(unit=1.0, precision=1e-9)
+            library.add(*cells.values())
+            library.write_gds(f"{file}.gds", max_points=0, timestamp=timestamp)
+            return
+
+        for cell, base_cells, filename, key in to_write:
+            # library of the cells, in units of meters with a precision of
+            # 1nm
+            library = gdstk.Library(unit=1.0, precision=1e-9)
+            library.add(cell, *base_cells)
+            library.write_gds(filename, max_points=0, timestamp=timestamp)
+        self._store(cache, to_write)
+
+    def _export_cell(self, cell_name):
+        # gdstk cell of a body, its paths are converted to polygons to be
+        # fractured
+        cell = gdstk.Cell(cell_name)
+        for objects in self.gds_cells[cell_name].values():
+            for obj in objects:
+                if isinstance(obj, gdstk.FlexPath):
+                    cell.add(*obj.to_polygons())
+                else:
+                    cell.add(obj.copy())
+        return cell, cell.dependencies(True)
+
+    def _add_empty(self, name, layer):
+        self._add(name, [])
+
+    def open_stream(self, file, max_points, strips=False):
+        # the cells are then written one by one by write_cell
+        self._stream = gdstk.GdsWriter(file+'.gds', unit=1.0, precision=1e-9,
+                                       max_points=0)
+        self._stream_max_points = max_points
+        self._stream_strips = strips
+        # names of the cells already written, the ids of the cells released
+        # by write_cell are reused by new cells
+        self._streamed = set()
+
+    def write_cell(self, cell_name):
+        """
+        Writes the cell to the file opened by open_stream, with the cells it
+        references that were not written yet, and releases its polygons.
+        """
+        cell, base_cells = self._export_cell(cell_name)
+        cells = [current_cell for current_cell in [cell]+base_cells
+                 if current_cell.name not in self._streamed]
+        self._fracture(cells, self._stream_max_points, self._stream_strips)
+        self._stream.write(*cells)
+        self._streamed.update(current_cell.name for current_cell in cells)
+
+        # the referenced cells are kept, other cells may reference them
+        for name in self.gds_cells.pop(cell_name):
+            del self.gds_object_instances[name]
+
+    def _fracture(self, cells, max_points, strips=False):
+        # fractures the polygons of cells with more than max_points vertices,
+        # the pieces replace them at the end of their cell. If strips, the
+        # pieces differ from those of Polygon.fracture, not their union
+        report = {}  # {layer: [time, polygons, vertices]}
+        for cell in cells:
+            if max_points > 4:
+                large = [polygon for polygon in cell.polygons
+                         if polygon.size > max_points]
+                if large:
+                    cell.remove(*large)
+                for polygon in large:
+                    start = time.perf_counter()
+                    if strips:
+                        polygons = _strips(polygon, max_points)
+                    else:
+                        polygons = [polygon]
+                    pieces = [piece for strip in polygons
+                              for piece in strip.fracture(
+                                  max_points=max_points, precision=1e-9)]
+                    report.setdefault(polygon.layer, [0, 0, 0])[0] += \
+                        time.perf_counter() - start
+                    cell.add(*pieces)
+            for polygon in cell.polygons:
+                layer_report = report.setdefault(polygon.layer, [0, 0, 0])
+                layer_report[1] += 1
+                layer_report[2] += polygon.size
+        self.fracture_report = {layer: dict(zip(('time', 'polygons',
+                                                 'vertices'), values))
+                                for layer, values in sorted(report.items())}
+
+    def digest(self, entity):
+        # hash of the polygons of entity, used as cache input when the
+        # entity cannot be described by its history
+        objects = self.gds_object_instances.get(entity.name)
+        if objects is None:
+            return None
+        digest = hashlib.sha256()
+        polygons = []
+        for obj in objects:
+            if isinstance(obj, gdstk.Reference):
+                # the placement and the referenced polygons, an array is not
+                # flattened
+                repetition = obj.repetition
+                digest.update(repr([obj.origin, obj.rotation,
+                                    repetition.columns, repetition.rows,
+                                    repetition.spacing, repetition.v1,
+                                    repetition.v2]).encode())
+                polygons += obj.cell.get_polygons()
+            else:
+                polygons += self._polygons([obj])
+        by_spec = {}
+        for polygon in polygons:
+            by_spec.setdefault((polygon.layer, polygon.datatype),
+                               []).append(polygon.points)
+        for spec in sorted(by_spec):
+            digest.update(repr(spec).encode())
+            for points in by_spec[spec]:
+                digest.update(np.ascontiguousarray(points, dtype=float))
+        return digest.hexdigest()
+
+    def sweep(self, entities, exprs, values, assignments, files, max_points,
+              processes=None):
+        # the gdstk objects cannot be sent to other processes
+        raise NotImplementedError("sweep is only available with \
+Modeler('gds')")
+
+    def get_bounding_box(self, entity):
+        objects = self.gds_object_instances.get(entity.name)
+        if not objects:
+            return None
+        bboxes = [obj.bounding_box() for obj in self._boxed(objects)]
+        bboxes = np.array([bbox for bbox in bboxes if bbox is not None])
+        if len(bboxes) == 0:
+            return None
+        return np.array([bboxes[:, 0].min(axis=0), bboxes[:, 1].max(axis=0)])
+
+    def _boxed(self, objects):
+        # objects having a bounding_box method
+        for obj in objects:
+            if isinstance(obj, gdstk.FlexPath):
+                yield from obj.to_polygons()
+            else:
+                yield obj
+
+    def get_vertices(self, entity):
+        polygons = self._flatten(entity)
+        return polygons[0].points
+
+    def text(self, pos, size, text, angle, horizontal, **kwargs):
+        pos, size = parse_entry(pos, size)
+        name = kwargs["name"]
+        layer = kwargs["layer"]
+        # the font of gdstk.text is not the one of gdspy
+        glyphs = gdspy.Text(text, size, pos, horizontal=horizontal,
+                            angle=angle, layer=layer)
+        self._add(name, [gdstk.Polygon(points, layer)
+                         for points in glyphs.polygons])
+
+    def polyline(self, points, closed, **kwargs):
+        name = kwargs['name']
+        layer = kwargs['layer']
+        points = parse_entry(points)
+
+        if isinstance(points, VectorArray):
+            points_2D = points[:, :2]
+        else:
+            points_2D = [[point[0], point[1]] for point in points]
+        self._add(name, [self._polyline(points_2D, closed, layer)])
+
+    def _polyline(self, points_2D, closed, layer):
+        if closed:
+            return gdstk.Polygon(points_2D, layer)
+        # the default tolerance would drop such a thin path
+        return gdstk.FlexPath(points_2D, 1e-9, tolerance=TOLERANCE,
+                              layer=layer)
+
+    def rect(self, pos, size, **kwargs):
+        pos, size = parse_entry(pos, size)
+        name = kwargs['name']
+        layer = kwargs['layer']
+        #This function neglects the z coordinate
+        points = [(pos[0],pos[1]), (pos[0]+size[0],pos[1]+0), (pos[0]+size[0],pos[1]+size[1]), (pos[0],pos[1]+size[1])]
+        self._add(name, [gdstk.Polygon(points, layer)])
+
+    def rects(self, pos, size, **kwargs):
+        # pos and size are numeric arrays of shape (N, 2), one name per rect
+        names = kwargs['name']
+        layer = kwargs['layer']
+        corners = np.stack([pos, pos+size*[1, 0], pos+size, pos+size*[0, 1]],
+                           axis=1)
+        for name, points in zip(names, corners):
+            self._add(name, [gdstk.Polygon(points, layer)])
+
+    def polylines(self, points_list, closed, **kwargs):
+        # points_list holds numeric arrays of shape (M, 2), one name for each
+        names = kwargs['name']
+        layer = kwargs['layer']
+        for name, points_2D in zip(names, points_list):
+            self._add(name, [self._polyline(points_2D, closed, layer)])
+
+    def disk(self, pos, radius, axis, number_of_points=None, **kwargs):
+        pos, radius = parse_entry(pos, radius)
+        name = kwargs['name']
+        layer = kwargs['layer']
+        assert axis=='Z', "axis must be 'Z' for the gdsModeler"
+        # the vertices (and the slices of large disks) of gdspy.Round,
+        # gdstk.ellipse does not place them the same
+        round1 = gdspy.Round((pos[0],pos[1]), radius, tolerance=TOLERANCE, number_of_points=number_of_points)
+        self._add(name, [gdstk.Polygon(points, layer)
+                         for points in round1.polygons])
+
+    def path(self, points, port, fillet, name='', corner="circular bend"):
+        if isinstance(points, np.ndarray):
+            points_2D = np.asarray(points)[:, :2]
+        else:
+            points_2D = [[point[0], point[1]] for point in points]
+
+        # the outlines of gdspy.FlexPath, gdstk.FlexPath drops a bend when
+        # two bends exactly fit the segment between them (slanted cables)
+        cable = gdspy.FlexPath(points_2D, port.widths, offset=port.offsets,
+                               corners=corner, bend_radius=fillet,
+                               gdsii_path=False, tolerance=TOLERANCE,
+                               max_points=0)
+
+        names = []
+        layers = []
+        for ii, points in enumerate(cable.get_polygons()):
+            current_name = name+'_'+port.subnames[ii]
+            names.append(current_name)
+            layers.append(port.layers[ii])
+            self._add(current_name, [gdstk.Polygon(points, port.layers[ii])])
+        return names, layers
+
+    def delete(self, entity):
+        del self.gds_object_instances[entity.name]
+        del self.gds_cells[entity.body.name][entity.name]
+
+    def unite(self, entities, keep_originals=True):
+        blank_entity = entities.pop(0)
+        tool_polygons = []
+        for tool_entity in entities:
+            tool_polygons += self._polygons(
+                self.gds_object_instances[tool_entity.name])
+        self._boolean(blank_entity, tool_polygons, 'or')
+        return blank_entity
+
+    def subtract(self, blank_entities, tool_entities, keep_originals=True):
+        if not isinstance(blank_entities, list):
+            blank_entities = [blank_entities]
+        tool_polygons = []
+        for tool_entity in tool_entities:
+            tool_polygons += self._polygons(
+                self.gds_object_instances[tool_entity.name])
+        if len(blank_entities) > 1 and tool_polygons:
+            # merged once rather than by the boolean of each blank
+            tool_polygons = gdstk.boolean(tool_polygons, [], 'or',
+                                          precision=TOLERANCE)
+        for blank_entity in blank_entities:
+            self._boolean(blank_entity, tool_polygons, 'not')
+
+    def _boolean(self, entity, tool_polygons, operation):
+        objects = self.gds_object_instances[entity.name]
+        result = gdstk.boolean(self._polygons(objects), tool_polygons,
+                               operation, precision=TOLERANCE,
+                               layer=entity.layer)
+        if not result:
+            print('Warning: the entity %s was fully subtracted'%entity.name)
+        objects[:] = result
+
+    def fillet(self, entity, radius, vertex_indices=None):
+        polygons = self._flatten(entity)
+        # the arcs of gdspy, gdstk.Polygon.fillet does not place their
+        # vertices the same
+        polygon_set = gdspy.PolygonSet([polygon.points for polygon in polygons])
+        if vertex_indices is None:
+            polygon_set.fillet(radius, max_points=0)
+        else:
+            radii = [0]*polygons[0].size
+            for rad, indices in zip(radius, vertex_indices):
+                for index in indices:
+                    radii[index]=rad
+            polygon_set.fillet([radii], max_points=0, precision=TOLERANCE)
+        polygons[:] = [gdstk.Polygon(points, polygon.layer, polygon.datatype)
+                       for points, polygon in zip(polygon_set.polygons,
+                                                  polygons)]
+
+    def translate(self, entities, vector):
+        '''vector is 3-dimentional but with a z=0 component'''
+        if not isinstance(entities, list):
+            entities = [entities]
+        for entity in entities:
+            for obj in self.gds_object_instances[entity.name]:
+                if isinstance(obj, gdstk.Reference):
+                    obj.origin = (obj.origin[0] + vector[0],
+                                  obj.origin[1] + vector[1])
+                else:
+                    obj.translate(vector[0], vector[1])
+
+    def rotate(self, entities, angle, center=None):
+        if(center is None):
+            center = (0, 0)
+
+        if not isinstance(entities, list):
+            entities = [entities]
+        center = (val(center[0]), val(center[1]))
+        angle = angle/360*2*np.pi
+        cos, sin = np.cos(angle), np.sin(angle)
+        for entity in entities:
+            for obj in self.gds_object_instances[entity.name]:
+                if isinstance(obj, gdstk.Reference):
+                    self._rotate_reference(obj, angle, center, cos, sin)
+                else:
+                    obj.rotate(angle, center)
+
+    def _rotate_reference(self, reference, angle, center, cos, sin):
+        # the origin turns around center, the lattice of an array with it
+        x, y = _rotated((reference.origin[0] - center[0],
+                         reference.origin[1] - center[1]), cos, sin)
+        reference.origin = (center[0] + x, center[1] + y)
+        reference.rotation += angle
+        repetition = reference.repetition
+        if repetition.columns is not None:
+            if repetition.spacing is not None:
+                v1 = (repetition.spacing[0], 0)
+                v2 = (0, repetition.spacing[1])
+            else:
+                v1, v2 = repetition.v1, repetition.v2
+            reference.repetition = gdstk.Repetition(
+                repetition.columns, repetition.rows,
+                v1=_rotated(v1, cos, sin), v2=_rotated(v2, cos, sin))
+
+    def rect_array(self, pos, size, columns, rows, spacing, **kwargs):
+        pos, size, spacing = parse_entry(pos, size, spacing)
+        name = kwargs['name']
+        layer = kwargs['layer']
+        size = (float(size[0]), float(size[1]))
+        base_cell = self._base_cell(('rect', layer, size),
+                                    lambda: [gdstk.Polygon([(0, 0),
+                                                            (size[0], 0), size,
+                                                            (0, size[1])],
+                                                           layer)])
+        array = gdstk.Reference(base_cell, (float(pos[0]), float(pos[1])),
+                                columns=columns, rows=rows,
+                                spacing=(float(spacing[0]), float(spacing[1])))
+        self._add(name, [array])
+
+    def array(self, entity, columns, rows, spacing, **kwargs):
+        # columns x rows copies of entity, spaced along x and y
+        name = kwargs['name']
+        objects = self.gds_object_instances[entity.name]
+        spacing = (float(spacing[0]), float(spacing[1]))
+        if len(objects) == 1 and isinstance(objects[0], gdstk.Reference) \
+                and not objects[0].rotation \
+                and objects[0].repetition.columns is None:
+            base_cell, origin = objects[0].cell, objects[0].origin
+        else:
+            base_cell = self._new_cell('%s_%s'%(entity.body.name, entity.name))
+            base_cell.add(*[obj.copy() for obj in objects])
+            origin = (0, 0)
+        array = gdstk.Reference(base_cell, origin, columns=columns, rows=rows,
+                                spacing=spacing)
+        self._add(name, [array])
@@ -10,21 +10,18 @@ import pythoncom
 import time
 from functools import wraps
 from sympy.parsing import sympy_parser
-from pint import UnitRegistry
 from win32com.client import Dispatch, CDispatch
 
 from ..utils import parse_entry, \
                             val, \
                             LENGTH_UNIT, \
                             Vector, \
-                            coor2angle
+                            coor2angle, \
+                            Q
                             #extract_value_unit, \
                             #extract_value_dim, \
                             #rem_unit, \
 
-ureg = UnitRegistry()
-Q = ureg.Quantity
-
 BASIS_ORDER = {"Zero Order": 0,
                "First Order": 1,
                "Second Order": 2,
@@ -837,7 +834,8 @@ class HfssModeler(COMWrapper):
                                "Selections:=", ','.join([entity1.name, entity2.name])])
         return name
 
-    def copy(self, entity):
+    def copy(self, entity, name=None):
+        # the pasted object is named by hfss
         self._modeler.Copy(["NAME:Selections", "Selections:=", entity.name])
         new_obj = self._modeler.Paste()
         return new_obj[0]
@@ -5,13 +5,27 @@ Created on Thu Nov 14 13:46:42 2019
 @author: Zaki
 """
 
+from functools import lru_cache
+import re
+
 from sympy.parsing import sympy_parser
-from pint import UnitRegistry
 import numpy
 import sympy
 
-ureg = UnitRegistry()
-Q = ureg.Quantity
+@lru_cache(maxsize=None)
+def _unit_registry():
+    # importing pint and building its registry takes longer than the rest of
+    # the import of HFSSdrawpy, it is only done when a unit is parsed by pint
+    from pint import UnitRegistry
+    return UnitRegistry()
+
+def __getattr__(name):
+    # ureg and Q are built on first access
+    if name == 'ureg':
+        return _unit_registry()
+    if name == 'Q':
+        return _unit_registry().Quantity
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
 
 LENGTH = '[length]'
 INDUCTANCE = '[length] ** 2 * [mass] / [current] ** 2 / [time] ** 2'
@@ -25,93 +39,399 @@ CAPACITANCE_UNIT = 'fF'
 RESISTANCE_UNIT = 'ohm'
 DIMENSIONLESS_UNIT = ''
 
-### List handling
-# Useful function to manipulate to_move entities and ports
-def find_last_list(list_entities):
-    # return the last list of a set of nested lists
+# units in which the variables are stored
+VARIABLE_UNITS = [LENGTH_UNIT, INDUCTANCE_UNIT, CAPACITANCE_UNIT,
+                  RESISTANCE_UNIT, DIMENSIONLESS_UNIT]
 
-    if isinstance(list_entities, list):
-        if len(list_entities)==0:
-            return list_entities
-        else:
-            if isinstance(list_entities[-1], list):
-                return find_last_list(list_entities[-1])
-            else:
-                return list_entities
-    else:
-        raise TypeError('There are no list')
+### Scope handling
+# Useful class to manipulate to_move entities and ports
 
-def find_penultimate_list(list_entities):
-    # return the last list of a set of nested lists
-    if isinstance(list_entities, list):
-        if len(list_entities)==0:
-            return False
-        else:
-            if isinstance(list_entities[-1], list):
-                if len(list_entities[-1])==0:
-                    return list_entities
-                else:
-                    if isinstance(list_entities[-1][-1], list):
-                        return find_penultimate_list(list_entities[-1])
-                    else:
-                        return list_entities
-            else:
-                return False
-    else:
-        raise TypeError('There are no list')
-
-def add_to_corresponding_list(elt, nested_list, added_elt):
-    # return the last list of a set of nested lists
-    if isinstance(nested_list, list):
-        if elt in nested_list:
-            index = nested_list.index(elt)
-            nested_list.insert(index+1, added_elt)
-            return True
-        else:
-            for elt_list in nested_list:
-                if isinstance(elt_list, list):
-                    if add_to_corresponding_list(elt, elt_list, added_elt):
-                        break
-            else:
-                return False
-            return True
-    else:
-        pass#raise TypeError('Argument is not a list')
+class ScopeStack():
+    """
+    Stack of the nested 'with body(pos, ori)' scopes of a body, used to keep
+    track of the entities (or ports) created in each scope.
+
+    Each scope is an insertion ordered dict used as an ordered set, and an
+    index maps every element to the scope that contains it. Adding, removing
+    and finding the scope of an element are O(1). Closing a scope moves its
+    elements to the enclosing scope, in time proportional to the number of
+    elements that the closing scope has to move anyway.
+    """
 
-def general_remove(elt, nested_list):
-    # same as list.remove(elt) but for a nested list
-    if isinstance(nested_list, list):
-        if elt in nested_list:
-            nested_list.remove(elt)
-            return True
-        else:
-            for elt_list in nested_list:
-                if isinstance(elt_list, list):
-                    success = general_remove(elt, elt_list)
-                    if success:
-                        break
-    else:
-        raise TypeError('Argument is not a list')
+    def __init__(self):
+        self.scopes = []
+        self.index = {}  # element: scope containing the element
 
-def find_corresponding_list(elt, nested_list):
-    # return the last list of a set of nested lists
-    if isinstance(nested_list, list):
-        if elt in nested_list:
-            return nested_list
+    def __len__(self):
+        return len(self.scopes)
+
+    def __contains__(self, elt):
+        return elt in self.index
+
+    def push(self):
+        # opens a new innermost scope
+        self.scopes.append({})
+
+    def pop(self):
+        # closes the innermost scope, its elements join the enclosing scope
+        scope = self.scopes.pop()
+        if self.scopes:
+            parent = self.scopes[-1]
+            parent.update(scope)
+            for elt in scope:
+                self.index[elt] = parent
         else:
-            for elt_list in nested_list:
-                if isinstance(elt_list, list):
-                    found_list = find_corresponding_list(elt, elt_list)
-                    if found_list:
-                        break
+            for elt in scope:
+                del self.index[elt]
+        return list(scope)
+
+    def innermost(self):
+        # elements of the innermost scope
+        if self.scopes:
+            return list(self.scopes[-1])
+        return []
+
+    def add(self, elt):
+        # adds elt to the innermost scope, if any
+        if self.scopes:
+            scope = self.scopes[-1]
+            scope[elt] = None
+            self.index[elt] = scope
+
+    def add_next_to(self, elt, added_elt):
+        # adds added_elt to the scope of elt, if elt is in a scope
+        scope = self.index.get(elt)
+        if scope is not None:
+            scope[added_elt] = None
+            self.index[added_elt] = scope
+
+    def remove(self, elt):
+        # removes elt from its scope, if any
+        scope = self.index.pop(elt, None)
+        if scope is not None:
+            del scope[elt]
+
+    def scope_of(self, elt):
+        # the scope containing elt or None
+        return self.index.get(elt)
+
+def ori_angle(ori):
+    # angle in degrees of an orientation given as a 2D vector or an angle
+    if isinstance(ori, (list, tuple, numpy.ndarray)):
+        if len(ori) != 2:
+            raise Exception("angle should be either a float or a 2-dim array")
+        return numpy.degrees(numpy.arctan2(ori[1], ori[0]))
+    return ori
+
+def _cos_sin(angle):
+    # exact for multiples of 90 degrees to keep symbolic expressions clean
+    quarter, rest = divmod(angle, 90)
+    if rest == 0:
+        return [(1, 0), (0, 1), (-1, 0), (0, -1)][int(quarter) % 4]
+    return numpy.cos(numpy.radians(angle)), numpy.sin(numpy.radians(angle))
+
+def compose_move(move, ori, pos):
+    """
+    Composes the pending move of an element with the move of a
+    'with body(pos, ori)' scope.
+
+    A move (angle, vector) stands for a rotation of angle degrees around the
+    origin followed by a translation of vector, None is the identity. The
+    scope move is applied after move.
+    """
+    angle = ori_angle(ori)
+    cos, sin = _cos_sin(angle)
+    pos = list(pos)+[0]*(3-len(pos))
+    if move is None:
+        return (angle, tuple(pos))
+    prev_angle, (x, y, z) = move
+    return (prev_angle+angle, (x*cos-y*sin+pos[0], x*sin+y*cos+pos[1],
+                               z+pos[2]))
+
+### Entity registry
+
+class LayerView():
+    """
+    Read-only view of the entities of a layer, in creation order.
+    The view is live: it reflects later additions and deletions, use list()
+    to get a snapshot. Membership test is O(1), indexing is O(n).
+    """
+
+    def __init__(self, entities):
+        self._entities = entities
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __iter__(self):
+        return iter(self._entities)
+
+    def __contains__(self, entity):
+        return entity in self._entities
+
+    def __getitem__(self, index):
+        return list(self._entities)[index]
+
+    def __add__(self, other):
+        return list(self)+list(other)
+
+    def __radd__(self, other):
+        return list(other)+list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def copy(self):
+        return list(self)
+
+class EntityRegistry():
+    """
+    Entities of a body sorted by layer. Each layer is an insertion ordered
+    dict used as an ordered set, so that adding and removing an entity are
+    O(1). registry[layer] is a LayerView of the layer.
+    """
+
+    def __init__(self, layers=()):
+        self._layers = {layer: {} for layer in layers}
+
+    def add(self, entity):
+        self._layers.setdefault(entity.layer, {})[entity] = None
+
+    def remove(self, entity):
+        del self._layers[entity.layer][entity]
+
+    def __getitem__(self, layer):
+        return LayerView(self._layers.setdefault(layer, {}))
+
+    def __contains__(self, layer):
+        return layer in self._layers
+
+    def __iter__(self):
+        return iter(self._layers)
+
+    def __len__(self):
+        return len(self._layers)
+
+    def keys(self):
+        return self._layers.keys()
+
+    def values(self):
+        return [LayerView(entities) for entities in self._layers.values()]
+
+    def items(self):
+        return [(layer, LayerView(entities))
+                for layer, entities in self._layers.items()]
+
+    def all(self):
+        # all the entities, layer by layer
+        for entities in self._layers.values():
+            yield from entities
+
+class SpatialIndex():
+    """
+    Bounding boxes [[xmin, ymin], [xmax, ymax]] of a set of elements.
+    The boxes are rows of a single numpy array so that region and nearest
+    queries are vectorized, the rows of removed elements are reused.
+    Insertion, update and removal are O(1).
+    """
+
+    def __init__(self):
+        self._boxes = numpy.full((16, 4), numpy.nan)
+        self._elements = [None]*16
+        self._rows = {}  # element: row in _boxes
+        self._free = []  # rows of removed elements
+        self._size = 0  # number of rows used so far
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, elt):
+        return elt in self._rows
+
+    def insert(self, elt, bbox):
+        # inserts elt or updates its bounding box
+        row = self._rows.get(elt)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
             else:
-                return False
-            return found_list
-    else:
+                if self._size == len(self._boxes):
+                    self._boxes = numpy.concatenate(
+                        [self._boxes, numpy.full(self._boxes.shape, numpy.nan)])
+                    self._elements += [None]*self._size
+                row = self._size
+                self._size += 1
+            self._rows[elt] = row
+            self._elements[row] = elt
+        (xmin, ymin), (xmax, ymax) = bbox
+        self._boxes[row] = (xmin, ymin, xmax, ymax)
+
+    def remove(self, elt):
+        row = self._rows.pop(elt, None)
+        if row is not None:
+            self._boxes[row] = numpy.nan
+            self._elements[row] = None
+            self._free.append(row)
+
+    def bbox(self, elt):
+        xmin, ymin, xmax, ymax = self._boxes[self._rows[elt]]
+        return [[xmin, ymin], [xmax, ymax]]
+
+    def query(self, bbox):
+        # elements whose bounding box overlaps bbox, holes have nan boxes
+        # which never compare True
+        (xmin, ymin), (xmax, ymax) = bbox
+        boxes = self._boxes[:self._size]
+        mask = ((boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin)
+                & (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin))
+        return [self._elements[row] for row in numpy.flatnonzero(mask)]
+
+    def nearest(self, point, n=1):
+        # list of the (distance, element) of the n elements whose bounding
+        # box is the closest to point, sorted by distance
+        x, y = point[0], point[1]
+        boxes = self._boxes[:self._size]
+        dx = numpy.maximum(numpy.maximum(boxes[:, 0]-x, x-boxes[:, 2]), 0)
+        dy = numpy.maximum(numpy.maximum(boxes[:, 1]-y, y-boxes[:, 3]), 0)
+        distances = numpy.hypot(dx, dy)
+        distances[numpy.isnan(distances)] = numpy.inf
+        n = min(n, len(self._rows))
+        if n == 0:
+            return []
+        rows = numpy.argpartition(distances, n-1)[:n]
+        rows = rows[numpy.argsort(distances[rows], kind='stable')]
+        return [(distances[row], self._elements[row]) for row in rows]
+
+# numeric bounding boxes [[xmin, ymin], [xmax, ymax]] in the xy plane
+
+def bbox_of(points):
+    points = numpy.array(points, dtype=float)[:, :2]
+    return [points.min(axis=0).tolist(), points.max(axis=0).tolist()]
+
+def rotate_bbox(bbox, angle):
+    # bounding box of bbox rotated by angle (degrees) around the origin
+    (xmin, ymin), (xmax, ymax) = bbox
+    corners = numpy.array([[xmin, ymin], [xmax, ymin],
+                           [xmax, ymax], [xmin, ymax]])
+    cos = numpy.cos(numpy.radians(angle))
+    sin = numpy.sin(numpy.radians(angle))
+    return bbox_of(corners.dot([[cos, sin], [-sin, cos]]))
+
+def translate_bbox(bbox, vector):
+    (xmin, ymin), (xmax, ymax) = bbox
+    return [[xmin+vector[0], ymin+vector[1]], [xmax+vector[0], ymax+vector[1]]]
+
+def union_bbox(bboxes):
+    # None as soon as one of the bounding boxes is unknown
+    if any(bbox is None for bbox in bboxes):
         return None
+    return bbox_of([corner for bbox in bboxes for corner in bbox])
 
 ### Naming
 
+def _split_names(name):
+    # all the (radical, number) such that name == radical+str(number)
+    ii = len(name)
+    while ii > 0 and name[ii-1] in '0123456789':
+        ii -= 1
+    for jj in range(ii, len(name)):
+        suffix = name[jj:]
+        if suffix[0] != '0' or len(suffix) == 1:
+            yield name[:jj], int(suffix)
+
+class NameRegistry(dict):
+    """
+    Dict of the instances of a class sorted by name (dict_instances of
+    Entity and Port). It also indexes, for each radical, the numbers already
+    used in names 'radical<number>', so that the first free name of a
+    radical is found in amortized O(1) instead of probing the dict with
+    increasing numbers.
+
+    Names can also be reserved without any instance, they are then
+    considered as used when generating new names.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.reserved = set()
+        self._numbers = {}  # radical: numbers used with this radical
+        self._skips = {}  # radical: {used number: next number to try}
+        self.update(*args, **kwargs)
+
+    def is_used(self, name):
+        return dict.__contains__(self, name) or name in self.reserved
+
+    def _use(self, name):
+        if not self.is_used(name):
+            for radical, number in _split_names(name):
+                self._numbers.setdefault(radical, set()).add(number)
+
+    def _release(self, name):
+        if not self.is_used(name):
+            for radical, number in _split_names(name):
+                self._numbers[radical].discard(number)
+                # skips may jump over the released number
+                self._skips.pop(radical, None)
+
+    def __setitem__(self, name, value):
+        self._use(name)
+        super().__setitem__(name, value)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self._release(name)
+
+    def pop(self, name, *default):
+        if dict.__contains__(self, name):
+            value = super().pop(name)
+            self._release(name)
+            return value
+        return super().pop(name, *default)
+
+    def popitem(self):
+        name, value = super().popitem()
+        self._release(name)
+        return name, value
+
+    def setdefault(self, name, default=None):
+        if not dict.__contains__(self, name):
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def clear(self):
+        super().clear()
+        self._numbers = {}
+        self._skips = {}
+        for name in self.reserved:
+            for radical, number in _split_names(name):
+                self._numbers.setdefault(radical, set()).add(number)
+
+    def reserve(self, name):
+        self._use(name)
+        self.reserved.add(name)
+
+    def unreserve(self, name):
+        self.reserved.discard(name)
+        self._release(name)
+
+    def first_free(self, radical, number):
+        # smallest n >= number such that radical+str(n) is not used
+        numbers = self._numbers.get(radical)
+        if not numbers:
+            return number
+        skips = self._skips.setdefault(radical, {})
+        visited = []
+        while number in numbers:
+            visited.append(number)
+            number = skips.get(number, number+1)
+        for visited_number in visited:
+            skips[visited_number] = number
+        return number
+
 def gen_name(name):
     # routine to mimic the default naming procedure of HFSS when object
     # already exists
@@ -131,7 +451,24 @@ def gen_name(name):
         suffix = str(number+1)
         return prefix+suffix
 
-def check_name(_class, name):
+def gen_free_name(_class, name):
+    # first name of the sequence gen_name(name), gen_name(gen_name(name))...
+    # that is not used by an instance of _class
+    end = ''
+    for ii in name[::-1]:
+        if ii.isdigit():
+            end+=ii
+        else:
+            break
+    if end=='' or int(end[::-1])==0:
+        radical, number = name, 1
+    else:
+        number = int(end[::-1])
+        radical, number = name[:-len(str(number))], number+1
+    return radical+str(_class.dict_instances.first_free(radical, number))
+
+def _radical_number(name):
+    # name == radical+str(number), number is 0 if name has no digit suffix
     end = ''
     for ii, char in enumerate(name[::-1]):
         if char.isdigit():
@@ -141,17 +478,29 @@ def check_name(_class, name):
     else:
         ii += 1
     if end == '':
-        radical = name
-        number = 0
-    else:
-        radical = name[:-ii]
-        number = int(end[::-1])
-    new_name = name
-    while(new_name in _class.dict_instances.keys()):
-        number+=1
-        new_name = radical+str(number)
-    if new_name != name:
-        print("%s: changed '%s' name into '%s'"%(_class.__name__, name, new_name))
+        return name, 0
+    return name[:-ii], int(end[::-1])
+
+def check_names(_class, name, n):
+    # n free names for a batch of new instances: name if it is free, then
+    # the next free names with the same radical, as check_name would give
+    # to successive instances
+    names = []
+    if n > 0 and not _class.dict_instances.is_used(name):
+        names.append(name)
+    radical, number = _radical_number(name)
+    while len(names) < n:
+        number = _class.dict_instances.first_free(radical, number+1)
+        names.append(radical+str(number))
+    return names
+
+def check_name(_class, name):
+    if not _class.dict_instances.is_used(name):
+        return name
+    radical, number = _radical_number(name)
+    new_name = radical+str(_class.dict_instances.first_free(radical,
+                                                            number+1))
+    print("%s: changed '%s' name into '%s'"%(_class.__name__, name, new_name))
     return new_name
 
 ### Litteral Expressions
@@ -181,25 +530,88 @@ def simplify_arith_expr(expr):
         print("Couldn't parse", expr)
         raise
 
+# Plain numbers and '<number><unit>' literals with the most common length
+# units are converted without pint, anything else falls back to pint.
+_LENGTH_FACTORS = {'cm': 1e-2, 'mm': 1e-3, 'um': 1e-6, 'nm': 1e-9,
+                   'pm': 1e-12}
+_LENGTH_LITERAL = re.compile(r'\s*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)'
+                             r'\s*(cm|mm|um|nm|pm)?\s*$')
+
+def _pint_value_unit(expr, units):
+    try:
+        return _unit_registry().Quantity(expr).to(units).magnitude
+    except Exception:
+        try:
+            return float(expr)
+        except Exception:
+            return expr
+
+@lru_cache(maxsize=4096)
+def _str_value_unit(expr, units):
+    if units == LENGTH_UNIT:
+        match = _LENGTH_LITERAL.match(expr)
+        if match is not None:
+            number, unit = match.groups()
+            if unit is None:
+                return float(number)
+            return float(number)*_LENGTH_FACTORS[unit]
+    return _pint_value_unit(expr, units)
+
 def extract_value_unit(expr, units):
     """
     :type expr: str
     :type units: str
     :return: float
     """
-    try:
-        return Q(expr).to(units).magnitude
-    except Exception:
-        try:
+    if isinstance(expr, str):
+        return _str_value_unit(expr, units)
+    if units == LENGTH_UNIT:
+        # a number cannot be converted to a length by pint
+        if isinstance(expr, (int, float, numpy.integer, numpy.floating)):
             return float(expr)
-        except Exception:
+        if isinstance(expr, numpy.ndarray):
             return expr
+        if isinstance(expr, sympy.Basic):
+            try:
+                return float(expr)
+            except TypeError:
+                return expr
+    return _pint_value_unit(expr, units)
+
+@lru_cache(maxsize=4096)
+def _str_value_dim(expr):
+    match = _LENGTH_LITERAL.match(expr)
+    if match is not None and match.group(2) is not None:
+        return LENGTH
+    return str(_unit_registry().Quantity(expr).dimensionality)
 
 def extract_value_dim(expr):
     """
     type expr: str
     """
-    return str(Q(expr).dimensionality)
+    if isinstance(expr, str):
+        return _str_value_dim(expr)
+    return str(_unit_registry().Quantity(expr).dimensionality)
+
+@lru_cache(maxsize=None)
+def _dimension_units():
+    # {dimensionality: unit} for the VARIABLE_UNITS, pint dimensionalities
+    # do not depend on the order of the base dimensions unlike their str
+    quantity = _unit_registry().Quantity
+    return {quantity(1, unit).dimensionality: unit for unit in VARIABLE_UNITS}
+
+@lru_cache(maxsize=4096)
+def _variable_unit(expr):
+    # unit in which the variable expr is stored, expr is parsed only once
+    match = _LENGTH_LITERAL.match(expr)
+    if match is not None and match.group(2) is not None:
+        return LENGTH_UNIT
+    dimensionality = _unit_registry().Quantity(expr).dimensionality
+    try:
+        return _dimension_units()[dimensionality]
+    except KeyError:
+        raise ValueError('%s has an unsupported dimension: %s'
+                         %(expr, dimensionality))
 
 def parse_entry(*entries, marker=True):
     #should take a list of tuple of list... of int, float or str...
@@ -229,6 +641,47 @@ def rem_unit(other):
     except Exception:
         return other
 
+### Numeric evaluation
+# Each sympy expression met by val() is evaluated once and the float is
+# cached together with the version of the variables store. The cached value
+# stays valid as long as none of its free symbols was modified by
+# store_variable. An expression that has to be evaluated again is compiled
+# with lambdify so that the following evaluations are plain function calls.
+
+_variables_version = 0
+_modified_at = {}  # symbol: version of the variables store when last modified
+_evaluated = {}  # expr: (version, float value, free symbols)
+_compiled = {}  # expr: (free symbols, compiled function)
+
+def _compile(expr):
+    try:
+        return _compiled[expr]
+    except KeyError:
+        symbols = tuple(sorted(expr.free_symbols, key=str))
+        compiled = (symbols, sympy.lambdify(symbols, expr, modules='math'))
+        _compiled[expr] = compiled
+        return compiled
+
+def _eval_expr(expr):
+    cached = _evaluated.get(expr)
+    if cached is None:
+        value = float(expr.evalf(subs=variables))
+        symbols = expr.free_symbols
+    else:
+        version, value, symbols = cached
+        if all(_modified_at.get(symbol, 0) <= version for symbol in symbols):
+            return value
+        # one of the variables changed since last evaluation
+        compiled_symbols, func = _compile(expr)
+        try:
+            value = float(func(*[variables[symbol]
+                                 for symbol in compiled_symbols]))
+        except Exception:
+            # missing or non numeric variable, let sympy handle it
+            value = float(expr.evalf(subs=variables))
+    _evaluated[expr] = (_variables_version, value, symbols)
+    return value
+
 def _val(elt):
     if isinstance(elt, (int, float, numpy.int64, numpy.float64, numpy.int32, numpy.float32)):
         return elt
@@ -238,6 +691,8 @@ def _val(elt):
         return tuple(_val(v) for v in elt)
     elif isinstance(elt, list):
         return [_val(v) for v in elt]
+    elif isinstance(elt, sympy.Basic):
+        return _eval_expr(elt)
     else:
         return float(elt.evalf(subs=variables))
 
@@ -248,11 +703,16 @@ def val(*entries, marker=True):
     #should take a list of tuple of list... of int, float or str...
     parsed = []
     for entry in entries:
-        if not isinstance(entry, (list, tuple, Vector)):
+        if not isinstance(entry, (list, tuple, Vector, VectorArray)):
             parsed.append(_val(entry))
         else:
-            if isinstance(entry, Vector):
-                parsed.append(Vector(val(*entry, marker=False)))
+            if isinstance(entry, VectorArray):
+                parsed.append(entry.val())
+            elif isinstance(entry, Vector):
+                if entry.is_numeric():
+                    parsed.append(entry.copy())
+                else:
+                    parsed.append(Vector(val(*entry, marker=False)))
             elif isinstance(entry, list):
                 parsed.append(val(*entry, marker=False))
             elif isinstance(entry, tuple):
@@ -264,6 +724,81 @@ def val(*entries, marker=True):
     else:
         return parsed
 
+_PLAIN_TYPES = (str, int, float, bool, type(None))
+
+def _sympy_entries(entries):
+    # yields the sympy expressions appearing in the (nested) entries
+    to_visit = list(entries)
+    while to_visit:
+        entry = to_visit.pop()
+        if type(entry) in _PLAIN_TYPES:
+            continue
+        if isinstance(entry, sympy.Basic):
+            yield entry
+        elif isinstance(entry, numpy.ndarray):
+            if entry.dtype == object:
+                to_visit.extend(entry.flat)
+        elif isinstance(entry, (list, tuple)):
+            to_visit.extend(entry)
+        elif isinstance(entry, dict):
+            to_visit.extend(entry.values())
+
+def free_symbols(*entries):
+    # set of the sympy symbols appearing in the (nested) entries
+    symbols = set()
+    for expr in _sympy_entries(entries):
+        symbols |= expr.free_symbols
+    return symbols
+
+def sympy_exprs(*entries):
+    # list without duplicates of the sympy expressions appearing in the
+    # (nested) entries
+    return list(dict.fromkeys(_sympy_entries(entries)))
+
+def val_sweep(exprs, assignments):
+    """
+    Evaluates the sympy expressions exprs for n assignments of some variables
+    at once, the other variables keep their current value.
+    The expressions depending on the swept variables are compiled together
+    in a single numpy function called on the arrays of values.
+
+    Inputs:
+    -------
+    exprs: list of sympy expressions
+    assignments: {symbol: array of n values in SI}
+
+    Outputs:
+    -------
+    values: array of shape (len(exprs), n)
+    """
+    n = len(next(iter(assignments.values())))
+    swept = set(assignments)
+    values = numpy.empty((len(exprs), n))
+    dependent = []
+    for ii, expr in enumerate(exprs):
+        if expr.free_symbols & swept:
+            dependent.append(ii)
+        else:
+            values[ii] = _val(expr)
+    if dependent:
+        dependent_exprs = [exprs[ii] for ii in dependent]
+        symbols = sorted(set().union(*[expr.free_symbols
+                                       for expr in dependent_exprs]), key=str)
+        func = sympy.lambdify(symbols, dependent_exprs, modules='numpy')
+        args = [numpy.asarray(assignments[symbol], dtype=float)
+                if symbol in assignments else variables[symbol]
+                for symbol in symbols]
+        for ii, row in zip(dependent, func(*args)):
+            values[ii] = row
+    return values
+
+def preset_values(values):
+    # values: iterable of (expr, value) evaluated elsewhere (e.g. by
+    # val_sweep) with the current variables, they are used by val()
+    for expr, value in values:
+        _evaluated[expr] = (_variables_version, float(value),
+                            expr.free_symbols)
+
 def way(vec):
     if vec[1] != 0:
         if abs(vec[0]/vec[1])<1e-2:
@@ -280,20 +815,44 @@ def way(vec):
 
 variables = {}
 
-def store_variable(symbol, value):  # put value in SI
+def parse_value(value):  # put value in SI
     if isinstance(value, str):
-        if LENGTH == extract_value_dim(value):
-            unit = LENGTH_UNIT
-        if INDUCTANCE == extract_value_dim(value):
-            unit = INDUCTANCE_UNIT
-        if CAPACITANCE == extract_value_dim(value):
-            unit = CAPACITANCE_UNIT
-        if RESISTANCE == extract_value_dim(value):
-            unit = RESISTANCE_UNIT
-        if DIMENSIONLESS == extract_value_dim(value):
-            unit = DIMENSIONLESS_UNIT
-        value = extract_value_unit(value, unit)
-    variables[symbol] = value
+        value = extract_value_unit(value, _variable_unit(value))
+    return value
+
+def store_variable(symbol, value):  # put value in SI
+    store_variables({symbol: value})
+
+def store_variables(assignments):
+    """
+    Stores several variables at once.
+    assignments: {symbol: value}, values are put in SI
+    Returns the list of the symbols whose value was modified.
+    """
+    global _variables_version
+    modified = []
+    for symbol, value in assignments.items():
+        value = parse_value(value)
+        if symbol in variables and variables[symbol] != value:
+            modified.append(symbol)
+        variables[symbol] = value
+    if modified:
+        # invalidates the values cached by val() that depend on the symbols
+        _variables_version += 1
+        for symbol in modified:
+            _modified_at[symbol] = _variables_version
+    return modified
+
+def _rot_matrix(other, ref):
+    # matrix of the change of coordinates performed by Vector.rot for
+    # numeric vectors, see Vector.rot for the details
+    ux, uy, uz = other.tolist()
+    norm = (ux**2+uy**2+uz**2)**0.5
+    ux, uy, uz = ux/norm, uy/norm, uz/norm
+    r0, r1, r2 = ref.tolist()
+    return numpy.array([[r2*ux-r1*uy, -r2*uy-r1*ux, r2*uz],
+                        [r2*uy-r0*ux, r2*ux+r0*uy, r0*uz],
+                        [r1*ux-r0*uy, r1*uy+r0*ux, -r1*uz]])
 
 class Vector(numpy.ndarray):
 
@@ -302,6 +861,10 @@ class Vector(numpy.ndarray):
     interface properly with HFSS.
     The class can be instenciate as a 2D vector, how ever, it will effectively
     creat a 3D vector with 0 for z axis.
+
+    When all the components are numbers, the vector is stored as a float64
+    array and the methods below work on floats directly. An object array of
+    sympy expressions is only used when a component is symbolic.
     """
 
     def __new__(cls, vec, vec_y=None, vec_z=None):
@@ -327,8 +890,23 @@ class Vector(numpy.ndarray):
         if(len(vec) == 2):
             vec = [vec[0], vec[1], 0]
 
-        obj = numpy.asarray(vec).view(cls)
-        return obj
+        obj = numpy.asarray(vec)
+        if obj.dtype.kind in 'biu':
+            obj = obj.astype(float)
+        elif obj.dtype == object:
+            try:
+                obj = obj.astype(float)
+            except (TypeError, ValueError):
+                pass  # at least one component is symbolic
+        return obj.view(cls)
+
+    @classmethod
+    def _from_floats(cls, x, y, z):
+        # skips the checks of __new__ when the components are known floats
+        return numpy.array((x, y, z), dtype=float).view(cls)
+
+    def is_numeric(self):
+        return self.dtype.kind == 'f'
 
     @staticmethod
     def check(elt):
@@ -351,15 +929,19 @@ class Vector(numpy.ndarray):
             return False
 
     def __eq__(self, other):
-        val_self = val(self)
-        val_other = val(other)
+        if self.is_numeric() and isinstance(other, Vector) and other.is_numeric():
+            val_self = self.tolist()
+            val_other = other.tolist()
+        else:
+            val_self = val(self)
+            val_other = val(other)
         bool_result = (equal_float(val_self[0], val_other[0]) and
                 equal_float(val_self[1], val_other[1]) and
                 equal_float(val_self[2], val_other[2]))
         return bool_result
 
     def index(self, elt):
-        val_self = val(self)
+        val_self = self.tolist() if self.is_numeric() else val(self)
         val_elt = val(elt)
         for ii, item in enumerate(val_self):
             if item == val_elt:
@@ -441,6 +1023,12 @@ class Vector(numpy.ndarray):
 
         if(Vector.check(other) and Vector.check(other)):
 
+            if (self.is_numeric() and isinstance(other, Vector)
+                    and other.is_numeric()):
+                x, y, z = self.tolist()
+                ox, oy, oz = other.tolist()
+                return Vector._from_floats(y*oz-z*oy, -(x*oz-z*ox), x*oy-y*ox)
+
             return Vector(self[1]*other[2]-self[2]*other[1],
                           -(self[0]*other[2]-self[2]*other[0]),
                           self[0]*other[1]-self[1]*other[0])
@@ -471,6 +1059,9 @@ class Vector(numpy.ndarray):
             raise TypeError('Could not perform dot operation')
 
     def norm(self):
+        if self.is_numeric():
+            x, y, z = self.tolist()
+            return (x**2+y**2+z**2)**0.5
         return (self[0]**2+self[1]**2+self[2]**2)**0.5
 
     def abs(self):
@@ -478,9 +1069,14 @@ class Vector(numpy.ndarray):
 
     def unit(self):
         norm = self.norm()
+        if self.is_numeric():
+            return self/norm
         return Vector([self[0]/norm, self[1]/norm, self[2]/norm])
 
     def orth(self):
+        if self.is_numeric():
+            x, y, _ = self.tolist()
+            return Vector._from_floats(-y, x, 0.)
         return Vector([-self[1], self[0]])
 
 #     def as_nda(self):
@@ -514,6 +1110,9 @@ class Vector(numpy.ndarray):
 
         other = Vector(other)
 
+        if self.is_numeric() and other.is_numeric() and ref.is_numeric():
+            return _rot_matrix(other, ref).dot(self).view(Vector)
+
         if(Vector.check(other) and Vector.check(ref)):
 
             other = Vector(other).unit()
@@ -544,6 +1143,163 @@ class Vector(numpy.ndarray):
         return Vector([self[0], self[1], -self[2]+2*offset])
 
 
+def _equal_float_arrays(array1, array2):
+    # elementwise equal_float
+    abs1, abs2 = numpy.abs(array1), numpy.abs(array2)
+    scale = numpy.where(abs1 > 1e-10, abs1, abs2)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rel_diff = numpy.abs(array1-array2)/scale
+    return (scale <= 1e-10) | (rel_diff < 1e-5)
+
+class VectorArray(numpy.ndarray):
+
+    """
+    VectorArray is an array of N 3D points, the batched counterpart of Vector.
+    It is meant to store point lists (polylines, paths, port positions) so
+    that they are transformed by a single numpy operation instead of one
+    Vector operation per point.
+    The class can be instanciated with a list of 2D or 3D points or with an
+    array of shape (N, 2) or (N, 3). As for Vector, 2D points are given a 0
+    z coordinate, and the array is float64 unless a coordinate is symbolic.
+    Indexing a single point returns a Vector.
+    """
+
+    def __new__(cls, points):
+        if not isinstance(points, numpy.ndarray):
+            points = [tuple(point) if len(point) == 3 else (*point, 0)
+                      for point in points]
+        obj = numpy.asarray(points)
+        if obj.size == 0:
+            obj = numpy.zeros((0, 3))
+        if obj.ndim != 2 or obj.shape[1] not in (2, 3):
+            raise TypeError('points must be of shape (N, 2) or (N, 3), not %s'
+                            % (obj.shape,))
+        if obj.shape[1] == 2:
+            obj = numpy.hstack((obj, numpy.zeros((len(obj), 1),
+                                                 dtype=obj.dtype)))
+        if obj.dtype.kind in 'biu':
+            obj = obj.astype(float)
+        elif obj.dtype == object:
+            try:
+                obj = obj.astype(float)
+            except (TypeError, ValueError):
+                pass  # at least one coordinate is symbolic
+        return obj.view(cls)
+
+    def __getitem__(self, index):
+        item = super().__getitem__(index)
+        if isinstance(item, numpy.ndarray):
+            if isinstance(index, (int, numpy.integer)):
+                return item.view(Vector)
+            if item.ndim != 2 or item.shape[1] != 3:
+                return item.view(numpy.ndarray)
+        return item
+
+    def __iter__(self):
+        for point in self.view(numpy.ndarray):
+            yield point.view(Vector)
+
+    def is_numeric(self):
+        return self.dtype.kind == 'f'
+
+    def to_vectors(self):
+        return list(self)
+
+    def val(self):
+        if self.is_numeric():
+            return self.copy()
+        return VectorArray([[_val(coor) for coor in point]
+                            for point in self.view(numpy.ndarray)])
+
+    def norm(self):
+        array = self.view(numpy.ndarray)
+        return (array[:, 0]**2+array[:, 1]**2+array[:, 2]**2)**0.5
+
+    def unit(self):
+        return self/self.norm()[:, None]
+
+    def orth(self):
+        array = self.view(numpy.ndarray)
+        result = numpy.zeros_like(array)
+        result[:, 0] = -array[:, 1]
+        result[:, 1] = array[:, 0]
+        return result.view(VectorArray)
+
+    def rot(self, other, ref=None):
+        """
+        Same change of coordinates as Vector.rot applied to every point.
+        """
+        ref = Vector([0, 0, 1]) if ref is None else Vector(ref)
+        other = Vector(other)
+        if self.is_numeric() and other.is_numeric() and ref.is_numeric():
+            matrix = _rot_matrix(other, ref)
+            return self.view(numpy.ndarray).dot(matrix.T).view(VectorArray)
+        return VectorArray([point.rot(other, ref) for point in self])
+
+    def translate(self, vector):
+        return self + Vector(vector)
+
+    def rotate(self, angle):
+        """
+        Rotates all points around the z axis, angle in degrees.
+        """
+        rad = angle/180*numpy.pi
+        cos, sin = numpy.cos(rad), numpy.sin(rad)
+        array = self.view(numpy.ndarray)
+        result = array.copy()
+        result[:, 0] = array[:, 0]*cos-array[:, 1]*sin
+        result[:, 1] = array[:, 0]*sin+array[:, 1]*cos
+        return result.view(VectorArray)
+
+    def _reflect(self, axis, offset):
+        result = self.view(numpy.ndarray).copy()
+        result[:, axis] = -result[:, axis]+2*offset
+        return result.view(VectorArray)
+
+    def refx(self, offset=0):
+        return self._reflect(1, offset)
+
+    def refy(self, offset=0):
+        return self._reflect(0, offset)
+
+    def refz(self, offset=0):
+        return self._reflect(2, offset)
+
+    def segments(self):
+        # vectors joining consecutive points
+        return self[1:]-self[:-1]
+
+    def way(self):
+        """
+        Row-wise equivalent of the way function, for numeric arrays. The
+        rows that are not aligned with x or y are set to nan.
+        """
+        array = self.view(numpy.ndarray)
+        x, y = array[:, 0], array[:, 1]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            vertical = (y != 0) & (numpy.abs(x/y) < 1e-2)
+            horizontal = ~vertical & (x != 0) & (numpy.abs(y/x) < 1e-2)
+        result = numpy.full(array.shape, numpy.nan)
+        result[vertical] = 0
+        result[vertical, 1] = numpy.sign(y[vertical])
+        result[horizontal] = 0
+        result[horizontal, 0] = numpy.sign(x[horizontal])
+        return result.view(VectorArray)
+
+    def remove_coinciding(self):
+        """
+        Removes consecutive coinciding points, as done point by point in
+        Body.polyline. Returns the cleaned array and the number of removed
+        points.
+        """
+        array = self.view(numpy.ndarray)
+        if len(array) < 2:
+            return self, 0
+        coinciding = _equal_float_arrays(array[:-1], array[1:]).all(axis=1)
+        keep = numpy.append(~coinciding, True)
+        return array[keep].view(VectorArray), int(coinciding.sum())
+
+
 # if(__name__ == "__main__"):
 
 #     x = Vector([1, 0, 0])
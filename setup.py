@@ -22,4 +22,5 @@ setuptools.setup(
     install_requires=['Pint>=0.10', 'numpy', 'sympy>=1.5.1', 
                       'gdspy>=1.5.2 ; platform_system!="Windows"',
                       'pywin32>=227 ; platform_system=="Windows"'],
+    extras_require={'gdstk': ['gdstk>=0.9']},
 )
\ No newline at end of file
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+gdspy vs gdstk benchmark: time of the drawing, of the booleans and of the
+export (fractured to 199 points) of the example chip of draw_cable_test.py
+with a slanted cable, whose ground plane is pierced by a grid of holes, with
+Modeler('gds') and Modeler('gdstk'), each in a fresh python process. The
+files written by both are compared layer by layer (area of their xor).
+
+Usage: python benchmark_gdstk.py [number of holes per side]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ['gds', 'gdstk']
+PHASES = ['draw', 'booleans', 'export']
+
+def run(mode, folder):
+    # draws and writes the chip, in the process started by main
+    from HFSSdrawpy import Modeler, Body
+    from HFSSdrawpy.parameters import TRACK, GAP
+    from HFSSdrawpy.utils import parse_entry
+    import HFSSdrawpy.libraries.example_elements as elt
+    # the unit registry is loaded by the first unit conversion
+    parse_entry('1 mm/s')
+
+    start = time.perf_counter()
+    pm = Modeler(mode)
+    chip = Body(pm, 'chip')
+    track = pm.set_variable('20um')
+    gap = pm.set_variable('10um', name='gap')
+    with chip(['0.5mm', '0.5mm'], [1, 0]):
+        port0, = elt.create_port(chip, [track, track+2*gap], name='port0')
+        with chip(['1.0mm', '0.1mm'], [-1, 0]):
+            port1, = elt.create_port(chip, name='port1')
+        with chip(['2.0mm', '0.1mm'], [-1, 0]):
+            port2, = elt.create_port(chip, [track, track+2*gap], name='port2')
+    chip.draw_cable(port0, port1, port2, is_bond=False, fillet='200um',
+                    to_meander=[0, 0, 0], meander_length=0)
+    # slanted route, its two bends exactly fit the segment between them
+    with chip(['0.5mm', '1.5mm'], [1, 0]):
+        port3, = elt.create_port(chip, [track, track+2*gap], name='port3')
+    with chip(['1.5mm', '1.6mm'], [-1, 0]):
+        port4, = elt.create_port(chip, [track, track+2*gap], name='port4')
+    chip.draw_cable(port3, port4, is_bond=False, fillet='100um',
+                    name='slanted')
+    pad = chip.rect(['2.5mm', '2.5mm'], ['0.3mm', '0.2mm'], layer=GAP,
+                    name='pad')
+    pad.fillet(40e-6)
+    chip.text(['0.2mm', '2.7mm'], '100um', 'HQC', layer=GAP)
+    pitch = 3e-3/N
+    chip.rects([[(ii+0.25)*pitch, (jj+0.25)*pitch] for ii in range(N)
+                for jj in range(N)], [pitch/2, pitch/2], layer=GAP,
+               name='hole_0')
+    ground_plane = chip.rect([0, 0], ['3mm', '3mm'], layer=TRACK)
+    draw = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ground_plane.subtract(chip.entities[GAP])
+    ground_plane.unite(chip.entities[TRACK])
+    # the booleans of gdspy are evaluated when the geometry is needed
+    ground_plane.bounding_box()
+    booleans = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pm.generate_gds(folder, mode, max_points=199)
+    export = time.perf_counter() - start
+    print(json.dumps({'draw': draw, 'booleans': booleans, 'export': export}))
+
+def layers(file):
+    import gdstk
+    polygons = {}
+    for polygon in gdstk.read_gds(file).top_level()[0].get_polygons():
+        polygons.setdefault(polygon.layer, []).append(polygon)
+    return polygons
+
+def main():
+    import gdstk
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    with tempfile.TemporaryDirectory() as folder:
+        times = {}
+        for mode in MODES:
+            result = subprocess.run([sys.executable, __file__, str(N), mode,
+                                     folder], env=env, check=True,
+                                    stdout=subprocess.PIPE,
+                                    universal_newlines=True)
+            times[mode] = json.loads(result.stdout.splitlines()[-1])
+        print('%d holes'%N**2)
+        for mode in MODES:
+            print('%s: %s'%(mode, ', '.join('%s %.2f s'%(phase, times[mode][phase])
+                                          for phase in PHASES)))
+        print('speedup: %s'%', '.join('%s x%.1f'%(phase, times['gds'][phase]
+                                                  /times['gdstk'][phase])
+                                      for phase in PHASES))
+
+        # geometric comparison of the files
+        gds, gdstk_ = [layers(os.path.join(folder, '%s.gds'%mode))
+                       for mode in MODES]
+        for layer in sorted(set(gds) | set(gdstk_)):
+            area = sum(polygon.area() for polygon in gds.get(layer, []))
+            xor = gdstk.boolean(gds.get(layer, []), gdstk_.get(layer, []),
+                                'xor', precision=1e-9)
+            print('layer %d: %d and %d polygons, xor area %.3g of %.3g m2'
+                  %(layer, len(gds.get(layer, [])), len(gdstk_.get(layer, [])),
+                    sum(polygon.area() for polygon in xor), area))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        run(*sys.argv[2:])
+    else:
+        main()
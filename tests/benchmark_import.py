@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Cold start benchmark: time of 'import HFSSdrawpy' and of the creation of a
+gds Modeler, each measured in fresh python processes.
+
+Usage: python benchmark_import.py [number of runs]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+N_RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = {'import': "import HFSSdrawpy",
+              'gds modeler': "import HFSSdrawpy; HFSSdrawpy.Modeler('gds')"}
+
+def cold_start(statement):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', statement], env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+baseline = sorted(cold_start('pass') for ii in range(N_RUNS))
+print('python startup: min %.1f ms'%(1e3*baseline[0]))
+for label, statement in STATEMENTS.items():
+    times = sorted(cold_start(statement) for ii in range(N_RUNS))
+    print('%s: min %.1f ms, median %.1f ms (python startup excluded)'
+          %(label, 1e3*(times[0]-baseline[0]),
+            1e3*(times[N_RUNS//2]-baseline[0])))
+
+# heaviest packages imported by a cold 'import HFSSdrawpy'
+result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                         STATEMENTS['import']],
+                        env=dict(os.environ, PYTHONPATH=ROOT),
+                        stderr=subprocess.PIPE, universal_newlines=True)
+packages = []
+for line in result.stderr.splitlines()[1:]:
+    self_time, cumulative, name = line.split('|')
+    name = name.strip()
+    if '.' not in name and not name.startswith('_') and name != 'HFSSdrawpy':
+        packages.append((int(cumulative), name))
+print('heaviest packages:')
+for cumulative, name in sorted(packages, reverse=True)[:5]:
+    print('  %s: %.1f ms'%(name, cumulative/1e3))
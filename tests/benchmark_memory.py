@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark: bytes allocated per entity (gds rectangle, including the
+gdspy polygon and the drawing history) and per port, measured with
+tracemalloc on a large number of instances.
+
+Usage: python benchmark_memory.py [number of instances]
+"""
+
+import sys
+import tracemalloc
+
+from HFSSdrawpy import Modeler, Body
+from HFSSdrawpy.core.port import Port
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+pm = Modeler('gds')
+chip = Body(pm, 'chip')
+
+def allocated(create):
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    objects = create()
+    stop = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in stop.compare_to(start, 'filename'))
+    return size/N, objects
+
+def create_entities():
+    return [chip.rect([ii*1e-5, 0], [5e-6, 5e-6], name='rect_%d'%ii)
+            for ii in range(N)]
+
+def create_ports():
+    return [Port(chip, 'port_%d'%ii, [ii*1e-5, 0], [1, 0], [1e-5], ['track'],
+                 [1], [0], False) for ii in range(N)]
+
+per_entity, entities = allocated(create_entities)
+per_port, ports = allocated(create_ports)
+print('%d instances'%N)
+print('entity: %.0f bytes (object: %d bytes, has __dict__: %s)'
+      %(per_entity, sys.getsizeof(entities[0]),
+        hasattr(entities[0], '__dict__')))
+print('port: %.0f bytes (object: %d bytes, has __dict__: %s)'
+      %(per_port, sys.getsizeof(ports[0]), hasattr(ports[0], '__dict__')))